@@ -0,0 +1,717 @@
+#!/usr/bin/env python
+
+# Benchmark harness for the Snappy Symbolication Server.
+#
+#   generate  Write a synthetic .sym corpus ({libName}/{breakpadId}/{sym}
+#             layout) and a JSONL file of symbolication requests against it
+#   serve     Serve a symbol store over HTTP, as a stand-in for symbolURLs
+#   replay    Replay a JSONL request log against a running server
+#   run       End-to-end: start the stand-in and a server, then replay the
+#             request log cold, warm, and after a restart on a warm disk cache
+#   micro     Microbenchmarks for ParseSymbolFile, SymbolInfo.Lookup, the
+#             DiskCache round trip with each codec, lookups in a memory
+#             mapped cache entry and large requests
+#   policy    Replay a request log (or a synthetic one) through each cache
+#             policy and compare hit rates, also across restarts that
+#             rebuild the MRU from the disk cache index
+#
+# Run "python bench/snappyBench.py <command> --help" for the options.
+
+import os
+import sys
+import json
+import time
+import gzip
+import random
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib2
+import Queue
+from StringIO import StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+gRepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, gRepoDir)
+
+from symUtil import GetSymbolFileName, mkdir_p
+
+#
+# Synthetic corpus
+#
+
+def MakeBreakpadId(rng):
+  return "%032X0" % rng.getrandbits(128)
+
+def WriteSymFile(path, libName, breakpadId, funcCount, linesPerFunc, rng):
+  mkdir_p(os.path.dirname(path))
+  address = 0x1000
+  funcs = []
+  with open(path, "w") as f:
+    f.write("MODULE windows x86_64 %s %s\n" % (breakpadId, libName))
+    for fileIndex in range(min(funcCount / 10 + 1, 5000)):
+      f.write("FILE %d c:/build/src/module%d/file%d.cpp\n" % (fileIndex, fileIndex / 50, fileIndex))
+    for funcIndex in range(funcCount):
+      size = rng.randint(0x10, 0x400)
+      name = "mozilla::ns%d::Class%d::Method%d(int, void*)" % (funcIndex % 97, funcIndex / 7, funcIndex)
+      if funcIndex % 5 == 0:
+        f.write("PUBLIC %x 0 %s\n" % (address, name))
+      else:
+        f.write("FUNC %x %x 0 %s\n" % (address, size, name))
+        lineAddress = address
+        for line in range(linesPerFunc):
+          step = max(size / linesPerFunc, 1)
+          f.write("%x %x %d %d\n" % (lineAddress, step, 100 + line, funcIndex % 5000))
+          lineAddress += step
+      funcs.append((address, size))
+      address += size
+  return funcs
+
+def GenerateCorpus(args):
+  rng = random.Random(args.seed)
+  storeDir = os.path.join(args.out, "symbols")
+
+  # One big xul plus many small DLLs, like a Windows profile
+  libs = [("xul.pdb", MakeBreakpadId(rng), args.xul_funcs)]
+  for i in range(args.dll_count):
+    libs.append(("lib%d.pdb" % i, MakeBreakpadId(rng), args.dll_funcs))
+
+  libFuncs = []
+  for libName, breakpadId, funcCount in libs:
+    path = os.path.join(storeDir, libName, breakpadId, GetSymbolFileName(libName))
+    funcs = WriteSymFile(path, libName, breakpadId, funcCount, args.lines_per_func, rng)
+    libFuncs.append((libName, breakpadId, funcs))
+    print >> sys.stderr, "Wrote %s (%d bytes)" % (path, os.path.getsize(path))
+
+  # Requests reference xul plus a random subset of the DLLs, with most
+  # frames landing in xul
+  requestsPath = os.path.join(args.out, "requests.jsonl")
+  with open(requestsPath, "w") as f:
+    for _ in range(args.requests):
+      modules = [libFuncs[0]] + rng.sample(libFuncs[1:], min(args.modules_per_request, len(libFuncs) - 1))
+      stacks = []
+      for _ in range(args.stacks_per_request):
+        stack = []
+        for _ in range(args.frames_per_stack):
+          moduleIndex = 0 if rng.random() < 0.7 else rng.randrange(len(modules))
+          address, size = rng.choice(modules[moduleIndex][2])
+          stack.append([moduleIndex, address + rng.randrange(size)])
+        stacks.append(stack)
+      request = {
+        "version": 4,
+        "memoryMap": [[libName, breakpadId] for libName, breakpadId, _ in modules],
+        "stacks": stacks
+      }
+      f.write(json.dumps(request) + "\n")
+  print >> sys.stderr, "Wrote %d requests to %s" % (args.requests, requestsPath)
+
+#
+# HTTP stand-in for symbolURLs
+#
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+def MakeSymbolStoreHandler(root, latency, failureRate, useGzip, rng):
+  class SymbolStoreHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+      pass
+
+    def do_GET(self):
+      if latency:
+        time.sleep(latency / 1000.0)
+      if failureRate and rng.random() < failureRate:
+        self.send_error(503)
+        return
+
+      path = os.path.normpath(os.path.join(root, urllib2.unquote(self.path.split("?")[0]).lstrip("/")))
+      if not path.startswith(root) or not os.path.isfile(path):
+        self.send_error(404)
+        return
+
+      with open(path, "rb") as f:
+        data = f.read()
+      self.send_response(200)
+      if useGzip:
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb") as gz:
+          gz.write(data)
+        data = buf.getvalue()
+        self.send_header("Content-Encoding", "gzip")
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+  return SymbolStoreHandler
+
+def StartSymbolStore(root, port, latency=0, failureRate=0.0, useGzip=False, seed=0):
+  handler = MakeSymbolStoreHandler(os.path.abspath(root), latency, failureRate, useGzip, random.Random(seed))
+  server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+def Serve(args):
+  server = StartSymbolStore(args.root, args.port, args.latency, args.failure_rate, args.gzip, args.seed)
+  print >> sys.stderr, "Serving %s on http://127.0.0.1:%d/" % (args.root, server.server_address[1])
+  try:
+    while True:
+      time.sleep(1)
+  except KeyboardInterrupt:
+    server.shutdown()
+
+#
+# Request replay
+#
+
+def Percentile(sortedValues, fraction):
+  if not sortedValues:
+    return 0.0
+  index = min(int(len(sortedValues) * fraction), len(sortedValues) - 1)
+  return sortedValues[index]
+
+def LoadRequests(path, limit):
+  with open(path) as f:
+    requests = [line.strip() for line in f if line.strip()]
+  if limit:
+    requests = requests[:limit]
+  return requests
+
+def ReplayRequests(serverURL, requests, concurrency):
+  work = Queue.Queue()
+  for index, body in enumerate(requests):
+    work.put((index, body))
+
+  latencies = []
+  errors = [0]
+  lock = threading.Lock()
+
+  def Worker():
+    while True:
+      try:
+        index, body = work.get_nowait()
+      except Queue.Empty:
+        return
+      start = time.time()
+      try:
+        request = urllib2.Request(serverURL, body, { "Content-Type": "application/json" })
+        urllib2.urlopen(request).read()
+        ok = True
+      except Exception:
+        ok = False
+      elapsed = time.time() - start
+      with lock:
+        latencies.append(elapsed)
+        if not ok:
+          errors[0] += 1
+
+  start = time.time()
+  threads = [threading.Thread(target=Worker) for _ in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  wallTime = time.time() - start
+
+  latencies.sort()
+  return {
+    "requests": len(requests),
+    "errors": errors[0],
+    "seconds": round(wallTime, 3),
+    "throughput": round(len(requests) / wallTime, 2) if wallTime else 0,
+    "p50Ms": round(Percentile(latencies, 0.50) * 1000, 2),
+    "p99Ms": round(Percentile(latencies, 0.99) * 1000, 2)
+  }
+
+def Replay(args):
+  requests = LoadRequests(args.requests, args.limit)
+  print json.dumps(ReplayRequests(args.server, requests, args.concurrency))
+
+#
+# End-to-end run
+#
+
+def GetFreePort():
+  s = socket.socket()
+  s.bind(("127.0.0.1", 0))
+  port = s.getsockname()[1]
+  s.close()
+  return port
+
+def GetChildPids(pid):
+  children = []
+  for entry in os.listdir("/proc"):
+    if not entry.isdigit():
+      continue
+    try:
+      with open("/proc/%s/stat" % entry) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    except IOError:
+      continue
+    if int(fields[1]) == pid:
+      children.append(int(entry))
+  return children
+
+# Peak RSS in KB of a process and its descendants (Linux only)
+def GetPeakRSS(pid):
+  total = 0
+  try:
+    with open("/proc/%d/status" % pid) as f:
+      for line in f:
+        if line.startswith("VmHWM:"):
+          total += int(line.split()[1])
+  except IOError:
+    pass
+  for child in GetChildPids(pid):
+    total += GetPeakRSS(child)
+  return total
+
+# Proportional set size in KB of a process and its descendants, where pages
+# shared by several processes are split between them (Linux only)
+def GetPSS(pid):
+  total = 0
+  try:
+    with open("/proc/%d/smaps_rollup" % pid) as f:
+      for line in f:
+        if line.startswith("Pss:"):
+          total += int(line.split()[1])
+  except IOError:
+    pass
+  for child in GetChildPids(pid):
+    total += GetPSS(child)
+  return total
+
+def WriteServerConfig(path, port, workDir, args, storeURL):
+  lines = [
+    "[General]",
+    "hostname = 127.0.0.1",
+    "portNumber = %d" % port,
+    "numWorkers = %d" % args.workers,
+    "maxResponseCacheSize = %d" % args.response_cache,
+    "[MemoryCache]",
+    "maxMemCacheFiles = %d" % args.mem_cache,
+    "[DiskCache]",
+    "diskCachePath = %s" % os.path.join(workDir, "cache"),
+    "maxDiskCacheFiles = %d" % args.disk_cache,
+    "sharedSymbolTables = %d" % args.shared,
+    "[Log]",
+    "logPath = %s" % os.path.join(workDir, "log"),
+    "logLevel = WARNING"
+  ]
+  if storeURL:
+    lines += ["[SymbolURLs]", "Bench = %s" % storeURL]
+  else:
+    lines += ["[SymbolPaths]", "Bench = %s" % os.path.abspath(os.path.join(args.corpus, "symbols"))]
+  with open(path, "w") as f:
+    f.write("\n".join(lines) + "\n")
+
+def StartServer(configPath, port):
+  server = subprocess.Popen(
+    [sys.executable, os.path.join(gRepoDir, "symbolicationWebService.py"), configPath])
+  url = "http://127.0.0.1:%d/" % port
+  for _ in range(600):
+    if server.poll() is not None:
+      raise Exception("Server exited with code %d" % server.returncode)
+    try:
+      urllib2.urlopen(url + "health/ready", timeout=1)
+      return server, url
+    except Exception:
+      time.sleep(0.1)
+  server.kill()
+  raise Exception("Server did not come up")
+
+def StopServer(server):
+  server.send_signal(signal.SIGINT)
+  for _ in range(100):
+    if server.poll() is not None:
+      return
+    time.sleep(0.1)
+  server.kill()
+
+def Run(args):
+  requests = LoadRequests(os.path.join(args.corpus, "requests.jsonl"), args.limit)
+  workDir = tempfile.mkdtemp(prefix="snappy-bench-")
+  port = GetFreePort()
+  configPath = os.path.join(workDir, "bench.ini")
+  store = None
+  results = {}
+
+  try:
+    storeURL = None
+    if args.source == "url":
+      store = StartSymbolStore(os.path.join(args.corpus, "symbols"), 0, args.latency, args.failure_rate, args.gzip)
+      storeURL = "http://127.0.0.1:%d/" % store.server_address[1]
+    WriteServerConfig(configPath, port, workDir, args, storeURL)
+
+    # Cold: empty caches. Warm: same process, caches populated.
+    server, url = StartServer(configPath, port)
+    try:
+      results["cold"] = ReplayRequests(url, requests, args.concurrency)
+      results["warm"] = ReplayRequests(url, requests, args.concurrency)
+      results["peakRssKB"] = GetPeakRSS(server.pid)
+      results["pssKB"] = GetPSS(server.pid)
+    finally:
+      StopServer(server)
+
+    # Restart: fresh process on top of the warm disk cache
+    server, url = StartServer(configPath, port)
+    try:
+      results["restart"] = ReplayRequests(url, requests, args.concurrency)
+      results["restartPeakRssKB"] = GetPeakRSS(server.pid)
+      results["restartPssKB"] = GetPSS(server.pid)
+    finally:
+      StopServer(server)
+  finally:
+    if store:
+      store.shutdown()
+    if not args.keep:
+      shutil.rmtree(workDir, ignore_errors=True)
+
+  print json.dumps(results, indent=2, sort_keys=True)
+
+#
+# Microbenchmarks
+#
+
+def BestOf(repeat, func):
+  best = None
+  result = None
+  for _ in range(repeat):
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, result
+
+def Micro(args):
+  from symLogging import SetLoggingOptions
+  from symParser import ParseSymbolFile
+  from symCache import DiskCache, CODECS, ENTRY_MAGIC
+  import cPickle as pickle
+
+  workDir = tempfile.mkdtemp(prefix="snappy-micro-")
+  SetLoggingOptions({ "logPath": os.path.join(workDir, "log"), "logLevel": "WARNING" })
+
+  rng = random.Random(args.seed)
+  symPath = os.path.join(workDir, "xul.pdb", "0", "xul.sym")
+  funcs = WriteSymFile(symPath, "xul.pdb", "0", args.xul_funcs, args.lines_per_func, rng)
+  results = { "symFileBytes": os.path.getsize(symPath) }
+
+  try:
+    def Parse():
+      with open(symPath) as f:
+        return ParseSymbolFile(f)
+    elapsed, symbolInfo = BestOf(args.repeat, Parse)
+    results["parseMs"] = round(elapsed * 1000, 2)
+    results["entries"] = symbolInfo.GetEntryCount()
+
+    addresses = [address + rng.randrange(size) for address, size in (rng.choice(funcs) for _ in range(args.lookups))]
+    def Lookups():
+      lookup = symbolInfo.Lookup
+      for address in addresses:
+        lookup(address)
+    elapsed, _ = BestOf(args.repeat, Lookups)
+    results["lookupNs"] = round(elapsed * 1e9 / len(addresses), 1)
+
+    # Disk cache round trip per codec, with the time of a Get split between
+    # reading the file, decompressing and unpickling
+    lib = ("xul.pdb", "0")
+    for codec in ["none"] + sorted(CODECS):
+      diskCache = DiskCache({
+        "diskCachePath": os.path.join(workDir, "cache-" + codec),
+        "maxDiskCacheFiles": 10,
+        "maxDiskCacheSize": 0,
+        "diskCacheCodec": codec,
+        "sharedSymbolTables": 0 })
+      path = diskCache.MakePath(lib[0], lib[1])
+      codecResults = results.setdefault("diskCache", {}).setdefault(codec, {})
+
+      elapsed, _ = BestOf(args.repeat, lambda: diskCache.Store(symbolInfo, lib[0], lib[1]))
+      codecResults["storeMs"] = round(elapsed * 1000, 2)
+      codecResults["entryBytes"] = os.path.getsize(path)
+      elapsed, _ = BestOf(args.repeat, lambda: diskCache.Get(lib))
+      codecResults["getMs"] = round(elapsed * 1000, 2)
+
+      def Read():
+        with open(path, "rb") as f:
+          return f.read()
+      elapsed, data = BestOf(args.repeat, Read)
+      codecResults["readMs"] = round(elapsed * 1000, 2)
+      if codec != "none":
+        decompress = CODECS[codec][2]
+        data = data[len(ENTRY_MAGIC) + 1:]
+        elapsed, data = BestOf(args.repeat, lambda: decompress(data))
+        codecResults["decompressMs"] = round(elapsed * 1000, 2)
+      elapsed, _ = BestOf(args.repeat, lambda: pickle.loads(data))
+      codecResults["unpickleMs"] = round(elapsed * 1000, 2)
+
+    # Shared symbol tables: the Get only maps the entry, lookups read it
+    diskCache = DiskCache({
+      "diskCachePath": os.path.join(workDir, "cache-shared"),
+      "maxDiskCacheFiles": 10,
+      "maxDiskCacheSize": 0,
+      "diskCacheCodec": "none",
+      "sharedSymbolTables": 1 })
+    sharedResults = results.setdefault("diskCache", {}).setdefault("shared", {})
+    elapsed, _ = BestOf(args.repeat, lambda: diskCache.Store(symbolInfo, lib[0], lib[1]))
+    sharedResults["storeMs"] = round(elapsed * 1000, 2)
+    sharedResults["entryBytes"] = os.path.getsize(diskCache.MakePath(lib[0], lib[1]))
+    elapsed, mappedSymbolInfo = BestOf(args.repeat, lambda: diskCache.Get(lib))
+    sharedResults["getMs"] = round(elapsed * 1000, 2)
+    def MappedLookups():
+      lookup = mappedSymbolInfo.Lookup
+      for address in addresses:
+        lookup(address)
+    elapsed, _ = BestOf(args.repeat, MappedLookups)
+    sharedResults["lookupNs"] = round(elapsed * 1e9 / len(addresses), 1)
+    results["request"] = MicroRequest(args, symbolInfo, funcs, rng)
+  finally:
+    shutil.rmtree(workDir, ignore_errors=True)
+
+  print json.dumps(results, indent=2, sort_keys=True)
+
+class StubSymFileManager(object):
+  def __init__(self, symbols):
+    self.sOptions = { "remoteSymbolServer": "" }
+    self.hashRing = None
+    self.symbols = symbols
+
+  def GetLibSymbolMaps(self, libs, timer=None):
+    return dict((lib, self.symbols[lib]) for lib in libs if lib in self.symbols)
+
+# Decoding, validation and symbolication of one large request, with every
+# library already in memory and every other library missing
+def MicroRequest(args, symbolInfo, funcs, rng):
+  from symbolicationRequest import SymbolicationRequest
+
+  memoryMap = [["lib%d.pdb" % i, MakeBreakpadId(rng)] for i in range(args.request_modules)]
+  symbols = dict((tuple(module), symbolInfo) for module in memoryMap[::2])
+  stacks = []
+  framesPerStack = args.request_frames / args.request_stacks
+  for _ in range(args.request_stacks):
+    stack = []
+    for _ in range(framesPerStack):
+      address, size = rng.choice(funcs)
+      stack.append([rng.randrange(-1, len(memoryMap)), address + rng.randrange(size)])
+    stacks.append(stack)
+  body = json.dumps({ "version": 4, "memoryMap": memoryMap, "stacks": stacks })
+  symFileManager = StubSymFileManager(symbols)
+
+  results = { "frames": framesPerStack * args.request_stacks, "modules": len(memoryMap) }
+  elapsed, decodedRequest = BestOf(args.repeat, lambda: json.loads(body))
+  results["decodeMs"] = round(elapsed * 1000, 2)
+  elapsed, _ = BestOf(args.repeat, lambda: SymbolicationRequest(symFileManager, decodedRequest, None))
+  results["validateMs"] = round(elapsed * 1000, 2)
+
+  def Symbolicate():
+    request = SymbolicationRequest(symFileManager, decodedRequest, None)
+    return [request.Symbolicate(stackIndex) for stackIndex in range(len(request.stacks))]
+  elapsed, _ = BestOf(args.repeat, Symbolicate)
+  results["validateAndSymbolicateMs"] = round(elapsed * 1000, 2)
+  return results
+
+#
+# Cache policy replay
+#
+
+def LoadTrace(path, limit):
+  trace = []
+  for body in LoadRequests(path, limit):
+    request = json.loads(body)
+    trace.append([tuple(module) for module in request.get("memoryMap", []) if module[0]])
+  return trace
+
+# Requests from a few current builds (one xul each, Zipf-distributed) and a
+# common set of DLLs, mixed with "scan" requests from unusual configurations
+# whose libraries are never seen again
+def MakeSyntheticTrace(args, rng):
+  def Zipf(n):
+    weights = [1.0 / (rank + 1) for rank in range(n)]
+    total = sum(weights)
+    point = rng.random() * total
+    for rank, weight in enumerate(weights):
+      point -= weight
+      if point <= 0:
+        return rank
+    return n - 1
+
+  trace = []
+  scans = 0
+  for _ in range(args.trace_requests):
+    if rng.random() < args.scan_rate:
+      scans += 1
+      trace.append([("rare%d-%d.pdb" % (scans, i), "0") for i in range(args.modules_per_request)])
+      continue
+    libs = set([("xul.pdb", "build%d" % Zipf(args.builds))])
+    while len(libs) < args.modules_per_request:
+      libs.add(("lib%d.pdb" % Zipf(args.dlls), "0"))
+    trace.append(list(libs))
+  return trace
+
+# With a disk cache, the server is restarted every "restartEvery" requests:
+# the MRU is then rebuilt from the disk cache index, and the policy starts
+# over. Restarts where the rebuilt MRU differs from the live one are counted.
+def SimulatePolicy(makePolicy, trace, memorySize, diskSize, diskCache=None, restartEvery=0):
+  policy = makePolicy()
+  MRU = []
+  counts = { "memoryHits": 0, "diskHits": 0, "misses": 0, "xulMisses": 0, "restartMismatches": 0 }
+  for requestIndex, libs in enumerate(trace):
+    if diskCache and restartEvery and requestIndex and requestIndex % restartEvery == 0:
+      restoredMRU = diskCache.GetCacheEntries()[:diskSize]
+      if restoredMRU != MRU:
+        counts["restartMismatches"] += 1
+      MRU = restoredMRU
+      policy = makePolicy()
+
+    positions = dict((lib, index) for index, lib in enumerate(MRU))
+    for lib in libs:
+      index = positions.get(lib)
+      if index is None:
+        counts["misses"] += 1
+        if lib[0] == "xul.pdb":
+          counts["xulMisses"] += 1
+      elif index < memorySize:
+        counts["memoryHits"] += 1
+      else:
+        counts["diskHits"] += 1
+    newMRU = policy.Update(MRU, libs, memorySize, diskSize)
+    if diskCache:
+      diskCache.Update(MRU, newMRU, dict.fromkeys(libs))
+    MRU = newMRU
+
+  lookups = sum(len(libs) for libs in trace)
+  results = {
+    "memoryHitRate": round(float(counts["memoryHits"]) / lookups, 4),
+    "diskHitRate": round(float(counts["diskHits"]) / lookups, 4),
+    "missRate": round(float(counts["misses"]) / lookups, 4),
+    "xulMisses": counts["xulMisses"]
+  }
+  if diskCache:
+    results["restartMismatches"] = counts["restartMismatches"]
+  return results
+
+def ReplayPolicies(args):
+  from symLogging import SetLoggingOptions
+  from symCache import DiskCache
+  from symCachePolicy import CACHE_POLICIES
+
+  # Only maintains the index, which is all a restart reads back
+  class IndexOnlyDiskCache(DiskCache):
+    def Store(self, symbolInfo, libName, breakpadId):
+      pass
+
+  workDir = tempfile.mkdtemp(prefix="snappy-policy-")
+  SetLoggingOptions({ "logPath": workDir, "logLevel": "WARNING" })
+  try:
+    if args.requests:
+      trace = LoadTrace(args.requests, args.limit)
+    else:
+      trace = MakeSyntheticTrace(args, random.Random(args.seed))
+
+    options = {
+      "maxMemCacheFiles": args.mem_cache,
+      "maxDiskCacheFiles": args.disk_cache,
+      "maxDiskCacheSize": 0,
+      "diskCacheCodec": "none",
+      "sharedSymbolTables": 0
+    }
+    results = {}
+    for name, policyClass in sorted(CACHE_POLICIES.iteritems()):
+      makePolicy = lambda: policyClass(options)
+      results[name] = SimulatePolicy(makePolicy, trace, args.mem_cache, args.disk_cache)
+      if args.restarts:
+        diskCache = IndexOnlyDiskCache(dict(options, diskCachePath=os.path.join(workDir, name)))
+        diskCache.GetCacheEntries()
+        restartEvery = max(len(trace) / (args.restarts + 1), 1)
+        results[name + "WithRestarts"] = SimulatePolicy(
+          makePolicy, trace, args.mem_cache, args.disk_cache, diskCache, restartEvery)
+  finally:
+    shutil.rmtree(workDir, ignore_errors=True)
+
+  print json.dumps(results, indent=2, sort_keys=True)
+
+def Main():
+  parser = argparse.ArgumentParser(description="Snappy Symbolication Server benchmarks")
+  subparsers = parser.add_subparsers()
+
+  corpusArgs = argparse.ArgumentParser(add_help=False)
+  corpusArgs.add_argument("--seed", type=int, default=1)
+  corpusArgs.add_argument("--xul-funcs", type=int, default=300000, help="FUNC/PUBLIC records in xul.sym")
+  corpusArgs.add_argument("--lines-per-func", type=int, default=4, help="line records per FUNC")
+
+  storeArgs = argparse.ArgumentParser(add_help=False)
+  storeArgs.add_argument("--latency", type=int, default=0, help="added latency per symbol download, in ms")
+  storeArgs.add_argument("--failure-rate", type=float, default=0.0, help="fraction of downloads answered with a 503")
+  storeArgs.add_argument("--gzip", action="store_true", help="serve gzip-encoded symbol files")
+
+  p = subparsers.add_parser("generate", parents=[corpusArgs], help="write a synthetic corpus")
+  p.add_argument("--out", required=True)
+  p.add_argument("--dll-count", type=int, default=200)
+  p.add_argument("--dll-funcs", type=int, default=2000)
+  p.add_argument("--requests", type=int, default=500)
+  p.add_argument("--modules-per-request", type=int, default=40)
+  p.add_argument("--stacks-per-request", type=int, default=1)
+  p.add_argument("--frames-per-stack", type=int, default=2000)
+  p.set_defaults(func=GenerateCorpus)
+
+  p = subparsers.add_parser("serve", parents=[storeArgs], help="serve a symbol store over HTTP")
+  p.add_argument("--root", required=True)
+  p.add_argument("--port", type=int, default=8001)
+  p.add_argument("--seed", type=int, default=1)
+  p.set_defaults(func=Serve)
+
+  p = subparsers.add_parser("replay", help="replay a request log against a server")
+  p.add_argument("--requests", required=True, help="JSONL file, one request per line")
+  p.add_argument("--server", default="http://127.0.0.1:8000/")
+  p.add_argument("--concurrency", type=int, default=8)
+  p.add_argument("--limit", type=int, default=0)
+  p.set_defaults(func=Replay)
+
+  p = subparsers.add_parser("run", parents=[storeArgs], help="end-to-end cold/warm/restart benchmark")
+  p.add_argument("--corpus", required=True, help="directory written by 'generate'")
+  p.add_argument("--source", choices=("path", "url"), default="url", help="serve symbols from symbolPaths or symbolURLs")
+  p.add_argument("--concurrency", type=int, default=8)
+  p.add_argument("--limit", type=int, default=0)
+  p.add_argument("--mem-cache", type=int, default=400)
+  p.add_argument("--disk-cache", type=int, default=1500)
+  p.add_argument("--workers", type=int, default=1, help="numWorkers of the server")
+  p.add_argument("--shared", action="store_true", help="enable sharedSymbolTables")
+  p.add_argument("--response-cache", type=int, default=0, help="maxResponseCacheSize of the server in MB (default: off)")
+  p.add_argument("--keep", action="store_true", help="keep the work directory (cache and logs)")
+  p.set_defaults(func=Run)
+
+  p = subparsers.add_parser("micro", parents=[corpusArgs], help="parse, lookup and disk cache microbenchmarks")
+  p.add_argument("--lookups", type=int, default=100000)
+  p.add_argument("--repeat", type=int, default=3)
+  p.add_argument("--request-frames", type=int, default=100000, help="frames of the large request benchmark")
+  p.add_argument("--request-stacks", type=int, default=10)
+  p.add_argument("--request-modules", type=int, default=200)
+  p.set_defaults(func=Micro)
+
+  p = subparsers.add_parser("policy", help="compare cache hit rates of the cache policies")
+  p.add_argument("--requests", help="JSONL request log to replay (default: synthetic trace)")
+  p.add_argument("--limit", type=int, default=0)
+  p.add_argument("--mem-cache", type=int, default=40)
+  p.add_argument("--disk-cache", type=int, default=150)
+  p.add_argument("--seed", type=int, default=1)
+  p.add_argument("--trace-requests", type=int, default=5000)
+  p.add_argument("--modules-per-request", type=int, default=30)
+  p.add_argument("--builds", type=int, default=10, help="distinct xul builds in the synthetic trace")
+  p.add_argument("--dlls", type=int, default=300, help="distinct DLLs in the synthetic trace")
+  p.add_argument("--scan-rate", type=float, default=0.05, help="fraction of one-off requests")
+  p.add_argument("--restarts", type=int, default=4, help="server restarts, on the disk cache index, of a second run of each policy")
+  p.set_defaults(func=ReplayPolicies)
+
+  args = parser.parse_args()
+  args.func(args)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(Main())
@@ -1,7 +1,42 @@
 import os
+import sys
+import time
+import zlib
+import tempfile
 import cPickle as pickle
-from symLogging import LogDebug
-from symUtil import mkdir_p
+from collections import OrderedDict
+from symLogging import LogDebug, LogError
+from symUtil import mkdir_p, FileLock, ReplaceFile, GetDefaultFileMode
+from symParser import COMPACT_MAGIC, WriteCompactSymbolFile, MapCompactSymbolFile
+
+# Optional faster codec for the disk cache
+try:
+  import lz4.frame as lz4frame
+except ImportError:
+  lz4frame = None
+
+# Compressed disk cache entries start with ENTRY_MAGIC and the codec id.
+# Uncompressed entries are plain pickles, as written by older versions.
+# With "sharedSymbolTables", entries are compact symbol files starting with
+# COMPACT_MAGIC instead.
+ENTRY_MAGIC = "SNPY"
+
+# Codec name: (id, compress, decompress)
+CODECS = {
+  "zlib": ("z", lambda data: zlib.compress(data, 1), zlib.decompress)
+}
+if lz4frame:
+  CODECS["lz4"] = ("4", lz4frame.compress, lz4frame.decompress)
+
+DECOMPRESSORS = dict((codecId, decompress) for codecId, _, decompress in CODECS.itervalues())
+
+def GetCodec(name):
+  if name == "none":
+    return None
+  if name not in CODECS:
+    LogError("Disk cache codec '{}' is not available, using zlib".format(name))
+    name = "zlib"
+  return CODECS[name]
 
 class Cache(object):
   def Update(self, oldMRU, newMRU, symbols):
@@ -22,30 +57,117 @@ class Cache(object):
     self.Insert(inserted, symbols)
 
 class MemoryCache(Cache):
+  NAME = "memory"
+
   def __init__(self, options):
     self.sCache = {}
     self.MAX_SIZE = options["maxMemCacheFiles"]
+    self.diskCache = None
+    # Entries of the previous run not loaded from the disk cache yet, most
+    # recently used first
+    self.unloaded = OrderedDict()
 
   def Evict(self, libs):
     for key in libs:
-      self.sCache.pop(key)
+      self.sCache.pop(key, None)
+      self.unloaded.pop(key, None)
 
   def Insert(self, libs, symbols):
     for lib in libs:
       self.sCache[lib] = symbols[lib]
+      self.unloaded.pop(lib, None)
 
   def Get(self, lib):
+    if self.unloaded.pop(lib, None):
+      self.Load(lib)
     return self.sCache.get(lib)
 
+  # Entries are only loaded on their first use, or by LoadNextEntry, so
+  # that a restarted worker can serve requests right away
   def LoadCacheEntries(self, MRU, diskCache):
-    for lib in MRU[:self.MAX_SIZE]:
-      self.sCache[lib] = diskCache.Get(lib)
+    self.diskCache = diskCache
+    self.unloaded = OrderedDict((lib, True) for lib in MRU[:self.MAX_SIZE])
 
+  # Load the most recently used entry not loaded yet, returns False when
+  # there is none left
+  def LoadNextEntry(self):
+    if not self.unloaded:
+      return False
+    lib, _ = self.unloaded.popitem(last=False)
+    self.Load(lib)
+    return True
+
+  def Load(self, lib):
+    symbolInfo = self.diskCache.Get(lib)
+    if symbolInfo is not None:
+      self.sCache[lib] = symbolInfo
+
+# The disk cache keeps one pickled SymbolInfo per library at
+# {diskCachePath}/{breakpadId}@{libName}, optionally compressed with the
+# "diskCacheCodec", written to a temporary file and renamed into place so a
+# crash never leaves a truncated entry. With "sharedSymbolTables", entries
+# are compact symbol files which are memory mapped rather than loaded, so
+# all the worker processes share the pages of a library. Besides the entry
+# count limit, the total size of the entries can be capped with
+# "maxDiskCacheSize" (in MB).
+# Recency survives restarts through an append-only index of
+# "+<TAB>breakpadId<TAB>libName" (used) and "-<TAB>..." (evicted) records,
+# oldest first, which is compacted once it grows past a few times the cache
+# size. Index updates happen under a file lock, so several worker processes
+# can share one cache directory.
 class DiskCache(Cache):
+  NAME = "disk"
+  INDEX_FILE = ".index"
+  LOCK_FILE = ".lock"
+  TEMP_PREFIX = ".tmp-"
+  # Compact the index when it holds this many times more records than the
+  # cache has entries
+  COMPACT_FACTOR = 4
+  # Average size in bytes of an index record until the index is read
+  INDEX_RECORD_SIZE = 50
+  # Age in seconds of temporary files considered left over from a crash
+  STALE_TEMP_AGE = 3600
+
   def __init__(self, options):
     self.diskCachePath = options["diskCachePath"]
     self.MAX_SIZE = options["maxDiskCacheFiles"]
     mkdir_p(self.diskCachePath)
+    self.indexPath = os.path.join(self.diskCachePath, self.INDEX_FILE)
+    self.lockPath = os.path.join(self.diskCachePath, self.LOCK_FILE)
+    # The index is appended to by every process sharing the cache, so the
+    # number of records it holds is estimated from its size
+    self.indexRecordSize = self.INDEX_RECORD_SIZE
+    # Cache files get the usual permissions rather than those of mkstemp
+    self.fileMode = GetDefaultFileMode()
+    self.shared = bool(options["sharedSymbolTables"])
+    if self.shared and sys.platform == 'win32':
+      LogError("Shared symbol tables aren't supported on Windows, ignoring 'sharedSymbolTables'")
+      self.shared = False
+    self.codec = GetCodec(options["diskCacheCodec"])
+    if self.shared and self.codec:
+      LogError("Compressed disk cache entries can't be shared, ignoring 'diskCacheCodec'")
+      self.codec = None
+    self.maxBytes = options["maxDiskCacheSize"] * 1024 * 1024
+    # Entry sizes, only tracked when there is a size budget. Entries stored
+    # by other processes are looked up on disk when first needed.
+    self.entrySizes = {}
+
+  def Update(self, oldMRU, newMRU, symbols):
+    super(DiskCache, self).Update(oldMRU, newMRU, symbols)
+
+    # Re-add every entry up to the last one the cache policy moved, most
+    # recently used last, so that replaying the index restores newMRU. The
+    # longest tail of newMRU still in its old order needs no records.
+    oldPositions = dict((lib, index) for index, lib in enumerate(oldMRU))
+    moved = len(newMRU)
+    nextPosition = len(oldMRU)
+    while moved > 0:
+      position = oldPositions.get(newMRU[moved - 1])
+      if position is None or position >= nextPosition:
+        break
+      nextPosition = position
+      moved -= 1
+    self.AppendIndex("+", reversed(newMRU[:moved]))
 
   def Evict(self, libs):
     for libName, breakpadId in libs:
@@ -56,10 +178,65 @@ class DiskCache(Cache):
         os.remove(path)
       except OSError:
         pass
+      self.entrySizes.pop((libName, breakpadId), None)
+    self.AppendIndex("-", libs)
+
+  # Evict least recently used entries until the cache fits in
+  # "maxDiskCacheSize", returns the remaining MRU
+  def TrimToBudget(self, MRU):
+    if not self.maxBytes:
+      return MRU
+
+    totalBytes = sum(self.GetEntrySize(lib) for lib in MRU)
+    keep = len(MRU)
+    while keep > 0 and totalBytes > self.maxBytes:
+      keep -= 1
+      totalBytes -= self.GetEntrySize(MRU[keep])
+
+    if keep == len(MRU):
+      return MRU
+
+    LogDebug("Evicting {} entries to fit the disk cache in {} bytes".format(len(MRU) - keep, self.maxBytes))
+    self.Evict(MRU[keep:])
+    return MRU[:keep]
+
+  def GetEntrySize(self, lib):
+    size = self.entrySizes.get(lib)
+    if size is None:
+      try:
+        size = os.path.getsize(self.MakePath(lib[0], lib[1]))
+      except OSError:
+        # Evicted by another process
+        return 0
+      self.entrySizes[lib] = size
+    return size
 
   def Insert(self, libs, symbols):
     for lib in libs:
-      self.Store(symbols[lib], lib[0], lib[1])
+      if not self.shared:
+        self.Store(symbols[lib], lib[0], lib[1])
+        continue
+
+      # Map the entry another worker stored, if any, rather than replacing
+      # it with a copy that no other worker maps
+      mappedSymbolInfo = self.GetMapped(lib)
+      if mappedSymbolInfo is None:
+        self.Store(symbols[lib], lib[0], lib[1])
+        mappedSymbolInfo = self.GetMapped(lib)
+      # Serve the lib from the mapping from now on, so that the memory
+      # cache holds the shared copy and the parsed one can be freed
+      if mappedSymbolInfo is not None:
+        symbols[lib] = mappedSymbolInfo
+
+  # The mapping of the entry of lib, None unless it is a compact symbol file
+  def GetMapped(self, lib):
+    try:
+      with open(self.MakePath(lib[0], lib[1]), 'rb') as f:
+        if f.read(len(COMPACT_MAGIC)) == COMPACT_MAGIC:
+          return MapCompactSymbolFile(f)
+    except IOError:
+      pass
+    return None
 
   def Get(self, lib):
     path = self.MakePath(lib[0], lib[1])
@@ -67,38 +244,156 @@ class DiskCache(Cache):
 
     try:
       with open(path, 'rb') as f:
-        symbolInfo = pickle.load(f)
-    except (IOError, pickle.PickleError) as ex:
+        if f.read(len(COMPACT_MAGIC)) == COMPACT_MAGIC:
+          return MapCompactSymbolFile(f)
+        f.seek(0)
+        data = f.read()
+      # Checked after COMPACT_MAGIC, which starts with ENTRY_MAGIC
+      if data.startswith(ENTRY_MAGIC):
+        data = DECOMPRESSORS[data[len(ENTRY_MAGIC)]](data[len(ENTRY_MAGIC) + 1:])
+      symbolInfo = pickle.loads(data)
+    except (IOError, EOFError, KeyError, zlib.error, pickle.PickleError) as ex:
       LogDebug("Could not load pickled lib [{}] [{}]: {}".format(lib[0], lib[1], ex))
 
     return symbolInfo
 
-  # Walk through the cache directory collecting files.
+  # Recover the MRU from the index, or from the cache directory when there
+  # is no index yet
   def GetCacheEntries(self):
+    with FileLock(self.lockPath):
+      if os.path.exists(self.indexPath):
+        MRU, _ = self.ReadIndex()
+      else:
+        MRU = self.WalkCacheEntries()
+        self.WriteIndex(MRU)
+    return MRU
+
+  def WalkCacheEntries(self):
     fileList = []
 
     # The symbolFiles are located at
     # {diskCachePath}/{breakpadId}@{libName}
-    for root, _, filenames in os.walk(self.diskCachePath):
-      for filename in filenames:
-        filePath = os.path.relpath(
-                    os.path.normpath(
-                      os.path.join(root, filename)), self.diskCachePath)
+    for filename in os.listdir(self.diskCachePath):
+      if filename.startswith(".") or "@" not in filename:
+        continue
 
-        # Get the libName and breakpadId components of the path
-        breakpadId, libName = filePath.split("@")
+      # Get the libName and breakpadId components of the path
+      breakpadId, libName = filename.split("@", 1)
 
-        fileList.append((libName, breakpadId))
+      fileList.append((libName, breakpadId))
 
     return fileList
 
+  def ReadIndex(self):
+    order = OrderedDict()
+    records = 0
+    with open(self.indexPath, "r") as f:
+      for line in f:
+        fields = line.rstrip("\n").split("\t")
+        # Skip records torn by a crash
+        if not line.endswith("\n") or len(fields) != 3 or fields[0] not in ("+", "-"):
+          continue
+        records += 1
+        lib = (fields[2], fields[1])
+        order.pop(lib, None)
+        if fields[0] == "+":
+          order[lib] = True
+      if records:
+        self.indexRecordSize = float(os.fstat(f.fileno()).st_size) / records
+
+    MRU = order.keys()
+    MRU.reverse()
+    return MRU, records
+
+  # Must be called with the lock held
+  def WriteIndex(self, MRU):
+    fd, tempPath = tempfile.mkstemp(dir=self.diskCachePath, prefix=self.TEMP_PREFIX)
+    records = self.FormatIndexRecords("+", reversed(MRU))
+    with os.fdopen(fd, "w") as f:
+      f.write(records)
+    os.chmod(tempPath, self.fileMode)
+    ReplaceFile(tempPath, self.indexPath)
+    if records:
+      self.indexRecordSize = float(len(records)) / records.count("\n")
+
+  def FormatIndexRecords(self, op, libs):
+    return "".join(
+      "{}\t{}\t{}\n".format(op, breakpadId, libName)
+      for libName, breakpadId in libs
+      if "\t" not in breakpadId and "\n" not in breakpadId)
+
+  def AppendIndex(self, op, libs):
+    records = self.FormatIndexRecords(op, libs)
+    if not records:
+      return
+
+    try:
+      with FileLock(self.lockPath):
+        # Reopen on every append, the index may have been compacted by
+        # another process in the meantime
+        with open(self.indexPath, "a") as f:
+          f.write(records)
+        indexRecords = os.path.getsize(self.indexPath) / self.indexRecordSize
+        if indexRecords > self.COMPACT_FACTOR * max(self.MAX_SIZE, 100):
+          self.Compact()
+    except (IOError, OSError) as ex:
+      LogError("Could not update disk cache index {}: {}".format(self.indexPath, ex))
+
+  # Must be called with the lock held
+  def Compact(self):
+    MRU, records = self.ReadIndex()
+    LogDebug("Compacting disk cache index from {} to {} records".format(records, len(MRU)))
+    self.WriteIndex(MRU[:self.MAX_SIZE])
+
+    # Entries pushed out by the other processes sharing the cache
+    for libName, breakpadId in MRU[self.MAX_SIZE:]:
+      try:
+        os.remove(self.MakePath(libName, breakpadId))
+      except OSError:
+        pass
+    self.RemoveStaleTempFiles()
+
+  def RemoveStaleTempFiles(self):
+    now = time.time()
+    for filename in os.listdir(self.diskCachePath):
+      if not filename.startswith(self.TEMP_PREFIX):
+        continue
+      path = os.path.join(self.diskCachePath, filename)
+      try:
+        if now - os.path.getmtime(path) > self.STALE_TEMP_AGE:
+          os.remove(path)
+      except OSError:
+        pass
+
   def Store(self, symbolInfo, libName, breakpadId):
     path = self.MakePath(libName, breakpadId)
-    with open(path, 'wb') as f:
-      pickle.dump(symbolInfo, f, pickle.HIGHEST_PROTOCOL)
+    fd, tempPath = tempfile.mkstemp(dir=self.diskCachePath, prefix=self.TEMP_PREFIX)
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        if self.shared:
+          WriteCompactSymbolFile(symbolInfo, f)
+        elif self.codec:
+          codecId, compress, _ = self.codec
+          data = compress(pickle.dumps(symbolInfo, pickle.HIGHEST_PROTOCOL))
+          f.write(ENTRY_MAGIC + codecId)
+          f.write(data)
+        else:
+          pickle.dump(symbolInfo, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+        size = f.tell()
+      os.chmod(tempPath, self.fileMode)
+      ReplaceFile(tempPath, path)
+      if self.maxBytes:
+        self.entrySizes[(libName, breakpadId)] = size
+    except (IOError, OSError) as ex:
+      LogError("Could not store lib [{}] [{}] in disk cache: {}".format(libName, breakpadId, ex))
+      try:
+        os.remove(tempPath)
+      except OSError:
+        pass
 
   def MakePath(self, libName, breakpadId):
     return os.path.join(
             self.diskCachePath,
             "@".join((breakpadId, libName)))
-
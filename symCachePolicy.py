@@ -0,0 +1,115 @@
+from symLogging import LogDebug, LogError
+
+# Policies deciding the new MRU of SymFileManager after a request used
+# "libs". The first "memorySize" entries of the MRU are in the memory cache,
+# and all of its entries (at most "diskSize") are in the disk cache.
+
+class MRUPolicy(object):
+  def __init__(self, options):
+    pass
+
+  # Every used lib goes to the front of the MRU
+  def Update(self, MRU, libs, memorySize, diskSize):
+    libs = libs[:diskSize]
+    libSet = set(libs)
+    newMRU = libs + [x for x in MRU if x not in libSet]
+    return newMRU[:diskSize]
+
+# Approximate access counts of libs: a count-min sketch of 4-bit counters,
+# halved every "sampleSize" increments so that old popularity fades away
+class FrequencySketch(object):
+  DEPTH = 4
+  MAX_COUNT = 15
+  SEEDS = (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F)
+
+  def __init__(self, capacity):
+    width = 64
+    while width < 4 * capacity:
+      width *= 2
+    self.mask = width - 1
+    self.rows = [bytearray(width) for _ in range(self.DEPTH)]
+    self.sampleSize = 10 * max(capacity, 64)
+    self.additions = 0
+
+  def Indexes(self, lib):
+    return [hash((seed, lib)) & self.mask for seed in self.SEEDS]
+
+  def Increment(self, lib):
+    for row, index in zip(self.rows, self.Indexes(lib)):
+      if row[index] < self.MAX_COUNT:
+        row[index] += 1
+
+    self.additions += 1
+    if self.additions >= self.sampleSize:
+      self.rows = [bytearray(count >> 1 for count in row) for row in self.rows]
+      self.additions /= 2
+
+  def Estimate(self, lib):
+    return min(row[index] for row, index in zip(self.rows, self.Indexes(lib)))
+
+# TinyLFU-style admission on top of the MRU order: a lib only enters a full
+# tier by pushing out the tier's least recently used entry if it has been
+# used more often recently. One-off libs, e.g. from a request with an unusual
+# memory map, then stay out of the memory cache (and out of a full disk
+# cache) instead of evicting hot libs.
+class TinyLFUPolicy(object):
+  def __init__(self, options):
+    self.sketch = FrequencySketch(options["maxDiskCacheFiles"])
+
+  def Update(self, MRU, libs, memorySize, diskSize):
+    libs = libs[:diskSize]
+    for lib in libs:
+      self.sketch.Increment(lib)
+
+    positions = dict((lib, index) for index, lib in enumerate(MRU))
+    libSet = set(libs)
+    estimate = self.sketch.Estimate
+
+    # Least recently used entries first
+    victims = [lib for lib in reversed(MRU) if lib not in libSet]
+    diskVictims = iter(victims)
+    memoryVictims = iter([lib for lib in victims if positions[lib] < memorySize])
+
+    freeDiskSlots = diskSize - len(MRU)
+    freeMemorySlots = memorySize - min(len(MRU), memorySize)
+    hot = []
+    warm = []
+    rejected = 0
+    for lib in libs:
+      index = positions.get(lib)
+      if index is None:
+        if freeDiskSlots > 0:
+          freeDiskSlots -= 1
+        elif estimate(lib) <= estimate(next(diskVictims, lib)):
+          rejected += 1
+          continue
+
+      if index is not None and index < memorySize:
+        hot.append(lib)
+      elif freeMemorySlots > 0:
+        freeMemorySlots -= 1
+        hot.append(lib)
+      elif estimate(lib) > estimate(next(memoryVictims, lib)):
+        hot.append(lib)
+      else:
+        warm.append(lib)
+
+    if rejected:
+      LogDebug("Cache admission rejected {} of {} libs".format(rejected, len(libs)))
+
+    memoryRest = [x for x in MRU[:memorySize] if x not in libSet]
+    diskRest = [x for x in MRU[memorySize:] if x not in libSet]
+    newMRU = hot + memoryRest + warm + diskRest
+    return newMRU[:diskSize]
+
+CACHE_POLICIES = {
+  "mru": MRUPolicy,
+  "tinylfu": TinyLFUPolicy
+}
+
+def CreateCachePolicy(options):
+  name = options["cachePolicy"]
+  if name not in CACHE_POLICIES:
+    LogError("Unknown cache policy '{}', using mru".format(name))
+    name = "mru"
+  return CACHE_POLICIES[name](options)
@@ -0,0 +1,46 @@
+import hashlib
+from bisect import bisect
+from symLogging import LogError, LogMessage
+
+# Consistent hashing of libraries over the nodes of a cluster.
+# Every node is placed at "clusterVirtualNodes" points of the ring, and a
+# (libName, breakpadId) pair is owned by the first node point following the
+# pair's own hash. Adding or removing a node only moves the libraries owned
+# by that node.
+
+def HashKey(key):
+  return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+def NormalizeNodeURL(url):
+  return url.rstrip("/") + "/"
+
+class HashRing(object):
+  def __init__(self, nodes, selfNode, virtualNodes):
+    self.nodes = [NormalizeNodeURL(node) for node in nodes]
+    self.selfNode = NormalizeNodeURL(selfNode)
+    ring = sorted(
+      (HashKey("{}#{}".format(node, i)), node)
+      for node in self.nodes
+      for i in range(virtualNodes))
+    self.hashes = [h for h, _ in ring]
+    self.owners = [node for _, node in ring]
+
+  def GetOwner(self, lib):
+    index = bisect(self.hashes, HashKey("/".join(lib))) % len(self.hashes)
+    return self.owners[index]
+
+  def IsLocal(self, lib):
+    return self.GetOwner(lib) == self.selfNode
+
+def CreateHashRing(options):
+  nodes = options["clusterNodes"]
+  if not nodes:
+    return None
+
+  selfNode = options["clusterSelf"]
+  if NormalizeNodeURL(selfNode) not in [NormalizeNodeURL(node) for node in nodes]:
+    LogError("'clusterSelf' ({}) is not one of the cluster nodes, running standalone".format(selfNode))
+    return None
+
+  LogMessage("Cluster mode with {} nodes, this node is {}".format(len(nodes), selfNode))
+  return HashRing(nodes, selfNode, options["clusterVirtualNodes"])
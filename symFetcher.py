@@ -1,83 +1,263 @@
 import os
+import time
+import Queue
+import random
+import socket
 import urllib2
 import urlparse
+import threading
 import contextlib
 import gzip
 from StringIO import StringIO
 from symLogging import LogDebug, LogMessage
-from symParser import ParseSymbolFile
-from symUtil import GetSymbolFileName
+from symParser import ParseSymbolFile, ReadCompactSymbolFile
+from symUtil import GetSymbolFileName, GetCompactSymbolFileName
+from symTiming import NULL_TIMER
 
 class SymbolFetcher(object):
   def __init__(self, options):
     self.sOptions = options
 
   # Fetch a symbol
-  def Fetch(self, libName, breakpadId):
+  def Fetch(self, libName, breakpadId, timer=NULL_TIMER):
     pass
 
 class PathFetcher(SymbolFetcher):
   def __init__(self, options):
     super(PathFetcher, self).__init__(options)
 
-  def Fetch(self, libName, breakpadId):
+  def Fetch(self, libName, breakpadId, timer=NULL_TIMER):
     LogDebug("Fetching [{}] [{}] in local paths".format(libName, breakpadId))
     symFileName = GetSymbolFileName(libName)
-    pathSuffix = os.path.join(libName, breakpadId, symFileName)
+    compactFileName = GetCompactSymbolFileName(libName)
     for symbolPath in self.sOptions["symbolPaths"]:
-      path = os.path.join(symbolPath, pathSuffix)
-      libSymbolMap = self.FetchSymbolsFromFile(path)
+      libPath = os.path.join(symbolPath, libName, breakpadId)
+      path = os.path.join(libPath, symFileName)
+      compactPath = os.path.join(libPath, compactFileName)
+      libSymbolMap = None
+      if self.IsCompactFileCurrent(compactPath, path):
+        libSymbolMap = self.FetchSymbolsFromCompactFile(compactPath, timer)
+      if not libSymbolMap:
+        libSymbolMap = self.FetchSymbolsFromFile(path, timer)
       if libSymbolMap:
         return libSymbolMap
     else:
       return None
 
-  def FetchSymbolsFromFile(self, path):
+  # Precompiled files (see symPrecompile.py) are used unless the .sym
+  # file is newer
+  def IsCompactFileCurrent(self, compactPath, path):
+    try:
+      compactTime = os.path.getmtime(compactPath)
+    except OSError:
+      return False
+
+    try:
+      return compactTime >= os.path.getmtime(path)
+    except OSError:
+      return True
+
+  def FetchSymbolsFromCompactFile(self, path, timer=NULL_TIMER):
+    try:
+      with open(path, "rb") as compactFile:
+        LogMessage("Loading precompiled symbols at " + path)
+        with timer.Phase("parse"):
+          return ReadCompactSymbolFile(compactFile)
+    except Exception as e:
+      LogDebug("Error opening file " + path + ": " + str(e))
+      return None
+
+  def FetchSymbolsFromFile(self, path, timer=NULL_TIMER):
     try:
       with open(path, "r") as symFile:
         LogMessage("Parsing SYM file at " + path)
-        return ParseSymbolFile(symFile)
+        # Local files are read while parsing, so this covers both
+        with timer.Phase("parse"):
+          return ParseSymbolFile(symFile)
     except Exception as e:
       LogDebug("Error opening file " + path + ": " + str(e))
       return None
 
+# Downloads use a timeout of "fetchTimeout" seconds per attempt and are
+# retried "fetchRetries" times on errors other than the file being missing,
+# after a randomized exponential backoff starting at "fetchBackoff" ms.
+# Mirrors are tried in order, unless "hedgeDelay" is set: a download from the
+# next mirror then starts whenever the previous ones haven't succeeded within
+# that many ms (or have failed), and the first download to succeed with a
+# valid symbol file wins.
 class URLFetcher(SymbolFetcher):
+  # HTTP status codes meaning that the mirror doesn't have the file
+  NOT_FOUND_CODES = (403, 404, 410)
+  # Size of the reads of a download body, between which the download's
+  # deadline and cancellation are checked
+  READ_SIZE = 64 * 1024
+
   def __init__(self, options):
     super(URLFetcher, self).__init__(options)
 
-  def Fetch(self, libName, breakpadId):
+  def Fetch(self, libName, breakpadId, timer=NULL_TIMER):
     LogDebug("Fetching [{}] [{}] in remote URLs".format(libName, breakpadId))
     symFileName = GetSymbolFileName(libName)
     urlSuffix = "/".join([libName, breakpadId, symFileName])
-    for symbolURL in self.sOptions["symbolURLs"]:
-      url = urlparse.urljoin(symbolURL, urlSuffix)
-      libSymbolMap = self.FetchSymbolsFromURL(url)
+    urls = [urlparse.urljoin(symbolURL, urlSuffix) for symbolURL in self.sOptions["symbolURLs"]]
+
+    if self.sOptions["hedgeDelay"] > 0 and len(urls) > 1:
+      downloads = self.RaceMirrors(urls, timer)
+    else:
+      downloads = self.DownloadInOrder(urls, timer)
+
+    for url, data in downloads:
+      libSymbolMap = self.ParseSymbols(url, data, timer)
       if libSymbolMap:
         return libSymbolMap
     else:
       return None
 
-  def FetchSymbolsFromURL(self, url):
+  def DownloadInOrder(self, urls, timer=NULL_TIMER):
+    for url in urls:
+      with timer.Phase("fetch"):
+        data = self.DownloadWithRetries(url, threading.Event())
+      if data is not None:
+        yield url, data
+
+  # Start a download from the next mirror every "hedgeDelay" ms, or as soon
+  # as one fails, and yield the successful downloads as they finish. The
+  # other mirrors keep racing while a download is parsed, in case it turns
+  # out to be invalid. Downloads still running once the caller is done are
+  # abandoned, and stop reading and retrying.
+  def RaceMirrors(self, urls, timer=NULL_TIMER):
+    results = Queue.Queue()
+    cancelled = threading.Event()
+    hedgeDelay = self.sOptions["hedgeDelay"] / 1000.0
+
+    def Download(url):
+      results.put((url, self.DownloadWithRetries(url, cancelled)))
+
+    started = 0
+    pending = 0
     try:
-      with contextlib.closing(urllib2.urlopen(url)) as request:
+      while True:
+        if started < len(urls):
+          LogDebug("Racing download of " + urls[started])
+          thread = threading.Thread(target=Download, args=(urls[started],))
+          thread.daemon = True
+          thread.start()
+          started += 1
+          pending += 1
+        elif not pending:
+          return
+
+        try:
+          with timer.Phase("fetch"):
+            url, data = results.get(timeout=hedgeDelay if started < len(urls) else None)
+        except Queue.Empty:
+          continue
+        pending -= 1
+        if data is not None:
+          yield url, data
+    finally:
+      cancelled.set()
+
+  def DownloadWithRetries(self, url, cancelled):
+    retries = self.sOptions["fetchRetries"]
+    for attempt in range(retries + 1):
+      try:
+        return self.Download(url, cancelled)
+      except Exception as e:
+        LogDebug("Attempt {} to download {} failed: {}".format(attempt + 1, url, e))
+        if attempt == retries:
+          return None
+      # Wakes up early when the download is no longer needed
+      backoff = self.sOptions["fetchBackoff"] / 1000.0 * (2 ** attempt)
+      if cancelled.wait(backoff * random.uniform(0.5, 1.5)):
+        return None
+
+  # Returns the decoded file, None if the mirror doesn't have it or the
+  # download was cancelled, and raises on errors worth a retry
+  def Download(self, url, cancelled):
+    timeout = self.sOptions["fetchTimeout"]
+    deadline = time.time() + timeout
+    try:
+      with contextlib.closing(urllib2.urlopen(url, timeout=timeout)) as request:
         if request.getcode() != 200:
           return None
         headers = request.info()
         contentEncoding = headers.get("Content-Encoding", "").lower()
-        if contentEncoding in ("gzip", "x-gzip", "deflate"):
-          data = request.read()
-          # We have to put it in a string IO because gzip looks for
-          # the "tell()" file object method
-          request = StringIO(data)
-          try:
-            with gzip.GzipFile(fileobj=request) as f:
-              request = StringIO(f.read())
-          except Exception:
-            request = StringIO(data.decode('zlib'))
-
-        LogMessage("Parsing SYM file at " + url)
-        return ParseSymbolFile(request)
+        data = self.ReadBody(request, deadline, cancelled)
+        if data is None:
+          return None
+    except urllib2.HTTPError as e:
+      if e.code in self.NOT_FOUND_CODES:
+        LogDebug("Error opening URL " + url + ": " + str(e))
+        return None
+      raise
+
+    if contentEncoding in ("gzip", "x-gzip", "deflate"):
+      # We have to put it in a string IO because gzip looks for
+      # the "tell()" file object method
+      request = StringIO(data)
+      try:
+        with gzip.GzipFile(fileobj=request) as f:
+          data = f.read()
+      except Exception:
+        data = data.decode('zlib')
+
+    return data
+
+  # Read the body of a download until its deadline, None if the download
+  # is cancelled first. The socket timeout only bounds each read from the
+  # socket, so a mirror sending a few bytes at a time would otherwise hold
+  # the download forever: the socket is shut down at the deadline instead.
+  def ReadBody(self, request, deadline, cancelled):
+    watchdog = threading.Timer(max(deadline - time.time(), 0), ShutdownSocket, (GetSocket(request),))
+    watchdog.daemon = True
+    watchdog.start()
+    try:
+      chunks = []
+      while time.time() < deadline:
+        if cancelled.is_set():
+          return None
+        chunk = request.read(self.READ_SIZE)
+        if not chunk:
+          break
+        chunks.append(chunk)
+      # A shut down socket reads as the end of the body
+      if time.time() >= deadline:
+        raise socket.timeout("download took more than {} seconds".format(self.sOptions["fetchTimeout"]))
+      return "".join(chunks)
+    finally:
+      watchdog.cancel()
+
+  def ParseSymbols(self, url, data, timer=NULL_TIMER):
+    if data is None:
+      return None
+
+    LogMessage("Parsing SYM file at " + url)
+    try:
+      with timer.Phase("parse"):
+        libSymbolMap = ParseSymbolFile(StringIO(data))
     except Exception as e:
-      LogDebug("Error opening URL " + url + ": " + str(e))
+      LogDebug("Error parsing " + url + ": " + str(e))
       return None
 
+    # E.g. an HTML error page served with a 200
+    if libSymbolMap is not None and not libSymbolMap.GetEntryCount():
+      LogDebug("No symbols in " + url)
+      return None
+    return libSymbolMap
+
+# The socket a urllib2 response reads from: urllib2 wraps the httplib
+# response, which wraps a file over the socket
+def GetSocket(response):
+  try:
+    return response.fp._sock.fp._sock
+  except AttributeError:
+    return None
+
+def ShutdownSocket(sock):
+  if sock is None:
+    return
+  try:
+    sock.shutdown(socket.SHUT_RDWR)
+  except socket.error:
+    pass
@@ -1,15 +1,30 @@
-from symLogging import LogDebug, LogMessage
+from symLogging import LogDebug, LogError, LogMessage
 from symFetcher import PathFetcher, URLFetcher
 from symCache import MemoryCache, DiskCache
+from symTiming import NULL_TIMER
+from symCluster import CreateHashRing
+from symCachePolicy import CreateCachePolicy
+from concurrent.futures import ThreadPoolExecutor
+
+import threading
 
 # Singleton for .SYM file cache management
 class SymFileManager:
   def __init__(self, options):
     self.sOptions = options
 
+    # Guards the MRU and the cache tiers against the prefetch threads
+    self.lock = threading.Lock()
+    self.prefetchPool = None
+    self.prefetching = set()
+
+    # Ownership of libraries in cluster mode, None when standalone
+    self.hashRing = CreateHashRing(options)
+
     self.fetchPipeline = (PathFetcher(options), URLFetcher(options))
     self.memoryCache = MemoryCache(options)
     self.diskCache = DiskCache(options)
+    self.cachePolicy = CreateCachePolicy(options)
     assert self.memoryCache.MAX_SIZE <= self.diskCache.MAX_SIZE
 
     self.MRU = self.diskCache.GetCacheEntries()
@@ -18,16 +33,33 @@ class SymFileManager:
       evicted = self.MRU[self.diskCache.MAX_SIZE:]
       self.MRU = self.MRU[:self.diskCache.MAX_SIZE]
       self.diskCache.Evict(evicted)
+    self.MRU = self.diskCache.TrimToBudget(self.MRU)
 
     self.memoryCache.LoadCacheEntries(self.MRU, self.diskCache)
+    if options["warmMemoryCache"]:
+      warmer = threading.Thread(target=self.WarmMemoryCache)
+      warmer.daemon = True
+      warmer.start()
 
     LogMessage("MRU loaded with {} entries".format(len(self.MRU)))
 
-  def GetLibSymbolMap(self, lib):
+  # Load the memory cache entries of the previous run in the background,
+  # one at a time so that requests can go in between
+  def WarmMemoryCache(self):
+    loaded = 0
+    while True:
+      with self.lock:
+        if not self.memoryCache.LoadNextEntry():
+          break
+      loaded += 1
+    LogMessage("Memory cache warmed up with {} entries".format(loaded))
+
+  def GetLibSymbolMap(self, lib, timer=NULL_TIMER):
     try:
       index = self.MRU.index(lib)
     except ValueError:
-      return self.Fetch(lib)
+      timer.AddLib(lib, "fetch")
+      return self.Fetch(lib, timer)
 
     if index < self.memoryCache.MAX_SIZE:
       cache = self.memoryCache
@@ -35,36 +67,45 @@ class SymFileManager:
       cache = self.diskCache
 
     LogDebug("Loading [{}] [{}] from {}".format(lib[0], lib[1], cache.__class__))
-    libSymbolMap = cache.Get(lib)
+    with timer.Phase("cacheLookup"):
+      libSymbolMap = cache.Get(lib)
 
     if libSymbolMap is None:
-      libSymbolMap = self.Fetch(lib)
+      # The entry is gone, e.g. evicted by another process sharing the disk
+      # cache. Drop it from the MRU so that it gets stored again.
+      self.MRU.remove(lib)
+      timer.AddLib(lib, "fetch")
+      libSymbolMap = self.Fetch(lib, timer)
+    else:
+      timer.AddLib(lib, cache.NAME)
 
     return libSymbolMap
 
-  def GetLibSymbolMaps(self, libs):
+  def GetLibSymbolMaps(self, libs, timer=NULL_TIMER):
+    with self.lock:
+      return self._GetLibSymbolMaps(libs, timer)
+
+  def _GetLibSymbolMaps(self, libs, timer):
     symbols = {}
 
     for lib in libs:
       # Empty lib name means client couldn't associate frame with any lib
       if lib[0]:
-        symbol = self.GetLibSymbolMap(lib)
+        symbol = self.GetLibSymbolMap(lib, timer)
         if symbol:
           symbols[lib] = symbol
 
-    newMRU = self.UpdateMRU(symbols)
-    self.diskCache.Update(self.MRU, newMRU, symbols)
-    self.memoryCache.Update(self.MRU, newMRU, symbols)
-    self.MRU = newMRU
+    with timer.Phase("cacheUpdate"):
+      self.UpdateCaches(self.UpdateMRU(symbols), symbols)
 
     LogDebug("Memory cache size = {}".format(len(self.memoryCache.sCache)))
     LogDebug("Disk cache size = {}".format(len(self.MRU)))
 
     return symbols
 
-  def Fetch(self, lib):
+  def Fetch(self, lib, timer=NULL_TIMER):
     for fetcher in self.fetchPipeline:
-      libSymbolMap = fetcher.Fetch(lib[0], lib[1])
+      libSymbolMap = fetcher.Fetch(lib[0], lib[1], timer)
       if libSymbolMap:
         return libSymbolMap
     else:
@@ -72,10 +113,69 @@ class SymFileManager:
         (", ".join(self.sOptions["symbolPaths"]), ", ".join(self.sOptions["symbolURLs"])))
       return None
 
-  def UpdateMRU(self, symbols):
-    maxSize = self.diskCache.MAX_SIZE
-    libs = symbols.keys()[:maxSize]
-    libSet = set(libs)
-    newMRU = libs + [x for x in self.MRU if x not in libSet]
-    return newMRU[:maxSize]
+  def UpdateCaches(self, newMRU, symbols):
+    self.diskCache.Update(self.MRU, newMRU, symbols)
+    newMRU = self.diskCache.TrimToBudget(newMRU)
+    self.memoryCache.Update(self.MRU, newMRU, symbols)
+    self.MRU = newMRU
 
+  def UpdateMRU(self, symbols):
+    return self.cachePolicy.Update(
+            self.MRU,
+            symbols.keys(),
+            self.memoryCache.MAX_SIZE,
+            self.diskCache.MAX_SIZE)
+
+  # Fetch, parse and cache libs in the background, at most
+  # "prefetchConcurrency" at a time. Prefetched libs go to the front of the
+  # MRU when toMemory is set, otherwise right behind the memory cache tier.
+  # With toMemory, libs only in the disk cache are moved to the memory cache.
+  def Prefetch(self, libs, toMemory):
+    if self.prefetchPool is None:
+      self.prefetchPool = ThreadPoolExecutor(self.sOptions["prefetchConcurrency"])
+
+    queued = 0
+    with self.lock:
+      for lib in libs:
+        if lib in self.prefetching or self.IsPrefetched(lib, toMemory):
+          continue
+        self.prefetching.add(lib)
+        self.prefetchPool.submit(self.PrefetchLib, lib, toMemory)
+        queued += 1
+
+    LogMessage("Queued {} of {} libs for prefetching".format(queued, len(libs)))
+    return queued
+
+  # Whether lib is in the disk cache, and in the memory cache if toMemory
+  def IsPrefetched(self, lib, toMemory):
+    if lib not in self.MRU:
+      return False
+    return not toMemory or self.MRU.index(lib) < self.memoryCache.MAX_SIZE
+
+  def PrefetchLib(self, lib, toMemory):
+    try:
+      # Libs being promoted to the memory cache are read from the disk cache
+      libSymbolMap = self.diskCache.Get(lib) if lib in self.MRU else None
+      if libSymbolMap is None:
+        libSymbolMap = self.Fetch(lib)
+      if libSymbolMap is None:
+        LogMessage("Could not prefetch [{}] [{}]".format(lib[0], lib[1]))
+        return
+
+      with self.lock:
+        if self.IsPrefetched(lib, toMemory):
+          return
+
+        # The disk cache keeps its entry if lib is already there
+        MRU = [x for x in self.MRU if x != lib]
+        position = 0 if toMemory else min(len(MRU), self.memoryCache.MAX_SIZE)
+        newMRU = MRU[:position] + [lib] + MRU[position:]
+        newMRU = newMRU[:self.diskCache.MAX_SIZE]
+        self.UpdateCaches(newMRU, { lib: libSymbolMap })
+
+      LogDebug("Prefetched [{}] [{}]".format(lib[0], lib[1]))
+    except Exception as e:
+      LogError("Exception while prefetching [{}] [{}]: {}".format(lib[0], lib[1], e))
+    finally:
+      with self.lock:
+        self.prefetching.discard(lib)
@@ -1,10 +1,25 @@
 from bisect import bisect
 from symLogging import LogDebug, LogError
 
+import mmap
+import struct
+
+# Compact binary symbol format ("precompiled" .symc files):
+#   header:    magic, entry count, size of the symbol blob
+#   addresses: entry count little-endian uint64, sorted
+#   offsets:   entry count + 1 little-endian uint32 into the symbol blob
+#   symbols:   symbol names separated by newlines
+COMPACT_MAGIC = "SNPYSYM1"
+COMPACT_HEADER = struct.Struct("<8sII")
+
 class SymbolInfo:
   def __init__(self, addressMap):
-    self.sortedAddresses = sorted(addressMap.keys())
-    self.sortedSymbols = [addressMap[address] for address in self.sortedAddresses]
+    sortedAddresses = sorted(addressMap.keys())
+    self.SetSortedEntries(sortedAddresses, [addressMap[address] for address in sortedAddresses])
+
+  def SetSortedEntries(self, sortedAddresses, sortedSymbols):
+    self.sortedAddresses = sortedAddresses
+    self.sortedSymbols = sortedSymbols
     self.entryCount = len(self.sortedAddresses)
 
   # TODO: Add checks for address < funcEnd ?
@@ -51,3 +66,91 @@ def ParseSymbolFile(symFile):
 
   return SymbolInfo(symbolMap)
 
+def WriteCompactSymbolFile(symbolInfo, f):
+  count = symbolInfo.GetEntryCount()
+  offsets = [0]
+  for symbol in symbolInfo.sortedSymbols:
+    offsets.append(offsets[-1] + len(symbol) + 1)
+  blob = "\n".join(symbolInfo.sortedSymbols)
+
+  f.write(COMPACT_HEADER.pack(COMPACT_MAGIC, count, len(blob)))
+  f.write(struct.pack("<%dQ" % count, *symbolInfo.sortedAddresses))
+  f.write(struct.pack("<%dI" % (count + 1), *offsets))
+  f.write(blob)
+
+def ReadCompactSymbolFile(f):
+  try:
+    data = f.read()
+    magic, count, blobSize = COMPACT_HEADER.unpack_from(data, 0)
+    if magic != COMPACT_MAGIC:
+      LogError("Bad magic in compact symbol file {}".format(f))
+      return None
+
+    offset = COMPACT_HEADER.size
+    sortedAddresses = list(struct.unpack_from("<%dQ" % count, data, offset))
+    offset += 8 * count + 4 * (count + 1)
+    blob = data[offset:offset + blobSize]
+    sortedSymbols = blob.split("\n") if count else []
+    if len(sortedSymbols) != count:
+      LogError("Corrupt compact symbol file {}".format(f))
+      return None
+  except (struct.error, IOError) as e:
+    LogError("Error reading compact symbol file {}: {}".format(f, e))
+    return None
+
+  symbolInfo = SymbolInfo({})
+  symbolInfo.SetSortedEntries(sortedAddresses, sortedSymbols)
+  return symbolInfo
+
+# SymbolInfo backed by a read-only memory mapping of a compact symbol file.
+# Nothing is deserialized: lookups read the addresses and names straight from
+# the mapped pages, which are shared through the page cache by every process
+# mapping the same file. Only the first address of every block of BLOCK_SIZE
+# addresses is kept in the process, to find the block to search.
+class MappedSymbolInfo(object):
+  BLOCK_SIZE = 16
+
+  def __init__(self, f):
+    self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, count, blobSize = COMPACT_HEADER.unpack_from(self.data, 0)
+    if magic != COMPACT_MAGIC:
+      raise ValueError("bad magic")
+
+    self.addressesOffset = COMPACT_HEADER.size
+    self.offsetsOffset = self.addressesOffset + 8 * count
+    self.blobOffset = self.offsetsOffset + 4 * (count + 1)
+    if self.blobOffset + blobSize > len(self.data):
+      raise ValueError("truncated file")
+
+    self.entryCount = count
+    address = struct.Struct("<Q")
+    blockBytes = 8 * self.BLOCK_SIZE
+    self.blockStarts = [
+      address.unpack_from(self.data, offset)[0]
+      for offset in xrange(self.addressesOffset, self.offsetsOffset, blockBytes)]
+    self.block = struct.Struct("<%dQ" % self.BLOCK_SIZE)
+    self.lastBlock = struct.Struct("<%dQ" % (count - self.BLOCK_SIZE * max(len(self.blockStarts) - 1, 0)))
+    self.symbolRange = struct.Struct("<II")
+
+  def Lookup(self, address):
+    block = bisect(self.blockStarts, address) - 1
+    if block < 0:
+      return None
+    blockStruct = self.block if block < len(self.blockStarts) - 1 else self.lastBlock
+    first = block * self.BLOCK_SIZE
+    addresses = blockStruct.unpack_from(self.data, self.addressesOffset + 8 * first)
+    nearest = first + bisect(addresses, address) - 1
+
+    start, end = self.symbolRange.unpack_from(self.data, self.offsetsOffset + 4 * nearest)
+    # Skip the newline separating the name from the next one
+    return self.data[self.blobOffset + start:self.blobOffset + end - 1]
+
+  def GetEntryCount(self):
+    return self.entryCount
+
+def MapCompactSymbolFile(f):
+  try:
+    return MappedSymbolInfo(f)
+  except (struct.error, ValueError, EnvironmentError) as e:
+    LogError("Error mapping compact symbol file {}: {}".format(f, e))
+    return None
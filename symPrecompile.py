@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# Convert every .sym file of local symbol stores into the compact binary
+# format read by PathFetcher, using all cores. The stores must use the
+# {libName}/{breakpadId}/{sym} layout of "symbolPaths". The precompiled file
+# is written next to its .sym file and is rebuilt when the .sym file changes.
+#
+#   python symPrecompile.py /mnt/netapp/breakpad/symbols_ffx [more stores...]
+
+import os
+import sys
+import stat
+import argparse
+import tempfile
+import multiprocessing
+from symLogging import SetLoggingOptions
+from symParser import ParseSymbolFile, WriteCompactSymbolFile
+from symUtil import GetSymbolFileName, GetCompactSymbolFileName, ReplaceFile
+
+def FindSymbolFiles(storePath, force):
+  for root, dirs, filenames in os.walk(storePath):
+    relPath = os.path.relpath(root, storePath)
+    depth = 0 if relPath == os.curdir else relPath.count(os.sep) + 1
+    # Only {libName}/{breakpadId} directories hold symbol files
+    if depth < 2:
+      continue
+    dirs[:] = []
+
+    libName = os.path.basename(os.path.dirname(root))
+    symFileName = GetSymbolFileName(libName)
+    if symFileName not in filenames:
+      continue
+
+    path = os.path.join(root, symFileName)
+    compactPath = os.path.join(root, GetCompactSymbolFileName(libName))
+    if not force and os.path.exists(compactPath) and \
+        os.path.getmtime(compactPath) >= os.path.getmtime(path):
+      continue
+
+    yield path, compactPath
+
+def CompileSymbolFile(paths):
+  path, compactPath = paths
+  try:
+    with open(path, "r") as symFile:
+      symbolInfo = ParseSymbolFile(symFile)
+    if symbolInfo is None:
+      return path, False
+
+    # Write-then-rename so the server never sees a partial file
+    fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(compactPath), prefix=".symc")
+    try:
+      with os.fdopen(fd, "wb") as f:
+        WriteCompactSymbolFile(symbolInfo, f)
+      # mkstemp only lets the owner read the file, the server may run as
+      # another user
+      os.chmod(tempPath, stat.S_IMODE(os.stat(path).st_mode))
+      ReplaceFile(tempPath, compactPath)
+    except Exception:
+      os.remove(tempPath)
+      raise
+  except Exception as e:
+    print >> sys.stderr, "Unable to precompile {}: {}".format(path, e)
+    return path, False
+
+  return path, True
+
+def Main():
+  parser = argparse.ArgumentParser(description="Precompile .sym files of local symbol stores")
+  parser.add_argument("stores", nargs="+", help="symbol store root directories")
+  parser.add_argument("--jobs", type=int, default=multiprocessing.cpu_count())
+  parser.add_argument("--force", action="store_true", help="rebuild up-to-date precompiled files")
+  parser.add_argument("--log-path", default=tempfile.gettempdir())
+  args = parser.parse_args()
+
+  logOptions = { "logPath": args.log_path, "logLevel": "WARNING" }
+  pool = multiprocessing.Pool(args.jobs, SetLoggingOptions, (logOptions,))
+
+  compiled = 0
+  failed = 0
+  try:
+    for store in args.stores:
+      for path, succeeded in pool.imap_unordered(CompileSymbolFile, FindSymbolFiles(store, args.force), 4):
+        if succeeded:
+          compiled += 1
+        else:
+          failed += 1
+  finally:
+    pool.close()
+    pool.join()
+
+  print "Precompiled {} symbol files, {} failed".format(compiled, failed)
+  return 1 if failed else 0
+
+if __name__ == '__main__':
+  sys.exit(Main())
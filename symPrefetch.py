@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# Ask a running server to fetch, parse and cache a list of libraries ahead of
+# user traffic, e.g. from a release pipeline once new symbols are uploaded.
+#
+# The libraries are read from a file (or stdin) with one
+# "<libName> <breakpadId>" pair per line:
+#
+#   xul.pdb 44E4EC8C2F41492B9369D6B9A059577C2
+#   libxul.so 2C6F6B9A4C1A0E2D8A3E5E3F9B5D1C2A0
+#
+# The token must match the "prefetchToken" option of the server. It is read
+# from the SNAPPY_PREFETCH_TOKEN environment variable unless --token is given.
+
+import os
+import sys
+import json
+import argparse
+import urllib2
+import urlparse
+
+def ReadLibs(f):
+  libs = []
+  for lineNum, line in enumerate(f):
+    line = line.strip()
+    if not line or line.startswith("#"):
+      continue
+    fields = line.split()
+    if len(fields) != 2:
+      raise ValueError("Line {} is not a '<libName> <breakpadId>' pair".format(lineNum + 1))
+    libs.append(fields)
+  return libs
+
+def Prefetch(serverURL, token, libs, toMemory):
+  url = urlparse.urljoin(serverURL, "/prefetch")
+  body = json.dumps({ "libs": libs, "memory": toMemory })
+  headers = {
+    "Content-Type": "application/json",
+    "Authorization": "Bearer " + token
+  }
+  response = urllib2.urlopen(urllib2.Request(url, body, headers))
+  return json.loads(response.read())
+
+def Main():
+  parser = argparse.ArgumentParser(description="Pre-warm the symbol caches of a Snappy server")
+  parser.add_argument("libs", nargs="?", default="-", help="file with '<libName> <breakpadId>' lines (default: stdin)")
+  parser.add_argument("--server", default="http://127.0.0.1:8000/")
+  parser.add_argument("--token", default=os.environ.get("SNAPPY_PREFETCH_TOKEN", ""))
+  parser.add_argument("--memory", action="store_true", help="also load the libraries in the memory cache")
+  parser.add_argument("--batch-size", type=int, default=100, help="libraries per prefetch request")
+  args = parser.parse_args()
+
+  if not args.token:
+    print >> sys.stderr, "No prefetch token, use --token or SNAPPY_PREFETCH_TOKEN"
+    return 1
+
+  try:
+    if args.libs == "-":
+      libs = ReadLibs(sys.stdin)
+    else:
+      with open(args.libs) as f:
+        libs = ReadLibs(f)
+  except (IOError, ValueError) as e:
+    print >> sys.stderr, "Unable to read libraries: " + str(e)
+    return 1
+
+  queued = 0
+  for start in range(0, len(libs), args.batch_size):
+    try:
+      response = Prefetch(args.server, args.token, libs[start:start + args.batch_size], args.memory)
+    except Exception as e:
+      print >> sys.stderr, "Prefetch request failed: " + str(e)
+      return 1
+    queued += response["queued"]
+
+  print "Queued {} of {} libraries for prefetching".format(queued, len(libs))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(Main())
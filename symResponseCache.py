@@ -0,0 +1,92 @@
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from symLogging import LogDebug
+
+# Bounded LRU cache of symbolication responses, kept in the web front end so
+# exact repeats of a request never reach the worker pool. Requests are keyed
+# by a hash of their canonical JSON form, so key order and whitespace don't
+# matter. Forwarded requests are never cached. Raw request bodies already
+# seen are mapped to their key, so that exact repeats skip the decoding.
+# Bodies larger than maxDecodedSize are never decoded, which would block
+# the front end, and are keyed by the hash of the raw body instead.
+class ResponseCache(object):
+  # Maximum number of raw request hashes remembered
+  MAX_ALIASES = 10000
+
+  def __init__(self, maxBytes, maxDecodedSize):
+    self.maxBytes = maxBytes
+    self.maxDecodedSize = maxDecodedSize
+    self.size = 0
+    # key -> (response, etag, expiry time or None)
+    self.entries = OrderedDict()
+    # raw body hash -> key
+    self.aliases = OrderedDict()
+
+  def MakeKey(self, decodedRequest):
+    if not isinstance(decodedRequest, dict) or "forwarded" in decodedRequest:
+      return None
+
+    canonicalRequest = json.dumps(decodedRequest, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonicalRequest).hexdigest()
+
+  # Returns the key of the request (None if it can't be cached), the cached
+  # (response, etag), if any, and the decoded request if the lookup had to
+  # decode it, so that the caller doesn't decode it again
+  def Lookup(self, requestBody):
+    rawKey = hashlib.sha1(requestBody).hexdigest()
+    if len(requestBody) > self.maxDecodedSize:
+      if '"forwarded"' in requestBody:
+        return None, None, None
+      return rawKey, self.Get(rawKey), None
+
+    decodedRequest = None
+    key = self.aliases.pop(rawKey, None)
+    if key is None:
+      try:
+        decodedRequest = json.loads(requestBody)
+      except ValueError:
+        return None, None, None
+      key = self.MakeKey(decodedRequest)
+      if key is None:
+        return None, None, decodedRequest
+
+    self.aliases[rawKey] = key
+    if len(self.aliases) > self.MAX_ALIASES:
+      self.aliases.popitem(last=False)
+    return key, self.Get(key), decodedRequest
+
+  def Get(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is None:
+      return None
+
+    response, etag, expiry = entry
+    if expiry is not None and expiry <= time.time():
+      self.size -= len(response)
+      return None
+
+    self.entries[key] = entry
+    return response, etag
+
+  # Entries with a ttl (in seconds) expire, the others are only evicted
+  def Put(self, key, response, etag, ttl=None):
+    if len(response) > self.maxBytes:
+      return
+
+    old = self.entries.pop(key, None)
+    if old is not None:
+      self.size -= len(old[0])
+
+    expiry = time.time() + ttl if ttl else None
+    self.entries[key] = (response, etag, expiry)
+    self.size += len(response)
+    while self.size > self.maxBytes:
+      _, evicted = self.entries.popitem(last=False)
+      self.size -= len(evicted[0])
+
+    LogDebug("Response cache holds {} entries, {} bytes".format(len(self.entries), self.size))
+
+def MakeETag(response):
+  return '"' + hashlib.sha1(response).hexdigest() + '"'
@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+
+# Lightweight per-request phase timers.
+# A PhaseTimer accumulates the wall time spent in each named phase of a
+# symbolication request, plus the libraries the request touched.
+# NullTimer has the same interface but does nothing, so call sites can
+# always instrument unconditionally at (almost) no cost when tracing is off.
+
+class PhaseTimer(object):
+  def __init__(self, startTime=None):
+    self.phases = OrderedDict()
+    self.libs = []
+    self.startTime = startTime or time.time()
+
+  def Phase(self, name):
+    return _Phase(self, name)
+
+  def Add(self, name, elapsed):
+    self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+  def AddLib(self, lib, source):
+    self.libs.append((lib[0], lib[1], source))
+
+  def GetTotal(self):
+    return time.time() - self.startTime
+
+  # Phase times in milliseconds, suitable for json.dumps
+  def GetPhases(self):
+    return OrderedDict((name, round(elapsed * 1000, 3)) for name, elapsed in self.phases.iteritems())
+
+  # Compact representation for the response header,
+  # e.g. "decode=0.102;validate=0.031;total=12.455"
+  def FormatHeader(self):
+    phases = self.GetPhases()
+    phases["total"] = round(self.GetTotal() * 1000, 3)
+    return ";".join("{}={}".format(name, ms) for name, ms in phases.iteritems())
+
+  def IsEnabled(self):
+    return True
+
+class _Phase(object):
+  __slots__ = ("timer", "name", "start")
+
+  def __init__(self, timer, name):
+    self.timer = timer
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.time()
+
+  def __exit__(self, excType, excValue, tb):
+    self.timer.Add(self.name, time.time() - self.start)
+    return False
+
+class NullTimer(object):
+  def Phase(self, name):
+    return _gNullPhase
+
+  def Add(self, name, elapsed):
+    pass
+
+  def AddLib(self, lib, source):
+    pass
+
+  def IsEnabled(self):
+    return False
+
+class _NullPhase(object):
+  __slots__ = ()
+
+  def __enter__(self):
+    pass
+
+  def __exit__(self, excType, excValue, tb):
+    return False
+
+_gNullPhase = _NullPhase()
+
+# Shared no-op timer, used as the default everywhere
+NULL_TIMER = NullTimer()
+
+# The total time counts from startTime, e.g. when the web front end received
+# the request, or from the creation of the timer
+def CreateTimer(options, startTime=None):
+  if options.get("enableTracing") or options.get("slowRequestThreshold"):
+    return PhaseTimer(startTime)
+  return NULL_TIMER
@@ -1,5 +1,12 @@
 import os
 import re
+import sys
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+  import msvcrt
 
 def mkdir_p(path):
   if not os.path.exists(path):
@@ -11,3 +18,47 @@ def GetSymbolFileName(libName):
     return re.sub(r"\.[^\.]+$", ".sym", libName)
   return libName + ".sym"
 
+def GetCompactSymbolFileName(libName):
+  # Precompiled symbols live next to the .sym file, like .pyc files
+  return GetSymbolFileName(libName) + "c"
+
+# Exclusive lock on a file, shared between processes (and between threads
+# using separate FileLock instances)
+class FileLock(object):
+  def __init__(self, path):
+    self.path = path
+    self.lockFile = None
+
+  def __enter__(self):
+    self.lockFile = open(self.path, "a+")
+    if fcntl:
+      fcntl.flock(self.lockFile.fileno(), fcntl.LOCK_EX)
+    else:
+      self.lockFile.seek(0)
+      msvcrt.locking(self.lockFile.fileno(), msvcrt.LK_LOCK, 1)
+    return self
+
+  def __exit__(self, excType, excValue, tb):
+    try:
+      if fcntl:
+        fcntl.flock(self.lockFile.fileno(), fcntl.LOCK_UN)
+      else:
+        self.lockFile.seek(0)
+        msvcrt.locking(self.lockFile.fileno(), msvcrt.LK_UNLCK, 1)
+    finally:
+      self.lockFile.close()
+      self.lockFile = None
+    return False
+
+# Mode of new files under the current umask, tempfile.mkstemp gives
+# its files mode 0600 instead
+def GetDefaultFileMode():
+  umask = os.umask(0)
+  os.umask(umask)
+  return 0666 & ~umask
+
+# Replace path with tempPath atomically (where the platform allows)
+def ReplaceFile(tempPath, path):
+  if sys.platform == 'win32' and os.path.exists(path):
+    os.remove(path)
+  os.rename(tempPath, path)
@@ -1,8 +1,10 @@
 from symLogging import LogDebug, LogError, LogMessage
+from symTiming import NULL_TIMER
 
 import re
 import json
 import urllib2
+from itertools import chain, izip
 
 # Precompiled regex for validating lib names
 gLibNameRE = re.compile("[0-9a-zA-Z_+\-\.]*$") # Empty lib name means client couldn't associate frame with any lib
@@ -13,11 +15,26 @@ gPdbSigRE2 = re.compile("[0-9a-fA-F]{32}$")
 # for symbolication. Also prevents loops.
 MAX_FORWARDED_REQUESTS = 3
 
+# Lib names that already passed gLibNameRE, so the regex runs once per name
+gValidLibNames = set()
+MAX_VALID_LIB_NAMES = 10000
+
+# Placeholder in SymbolicationRequest.moduleSymbols for modules
+# symbolicated by another cluster node
+OWNED_ELSEWHERE = object()
+
 def getModuleV3(libName, breakpadId):
-  if not isinstance(libName, basestring) or not gLibNameRE.match(libName):
+  if not isinstance(libName, basestring):
     LogDebug("Bad library name: " + str(libName))
     return None
 
+  if libName not in gValidLibNames:
+    if not gLibNameRE.match(libName):
+      LogDebug("Bad library name: " + str(libName))
+      return None
+    if len(gValidLibNames) < MAX_VALID_LIB_NAMES:
+      gValidLibNames.add(libName)
+
   if not isinstance(breakpadId, basestring):
     LogDebug("Bad breakpad id: " + str(breakpadId))
     return None
@@ -25,15 +42,17 @@ def getModuleV3(libName, breakpadId):
   return (libName, breakpadId)
 
 class SymbolicationRequest:
-  def __init__(self, symFileManager, rawRequests, remoteIp):
+  def __init__(self, symFileManager, rawRequests, remoteIp, timer=NULL_TIMER):
     self.remoteIp = remoteIp
+    self.timer = timer
     self.Reset()
     self.symFileManager = symFileManager
     self.stacks = []
     self.combinedMemoryMap = []
     self.knownModules = []
     self.includeKnownModulesInResponse = True
-    self.ParseRequests(rawRequests)
+    with self.timer.Phase("validate"):
+      self.ParseRequests(rawRequests)
 
   def LogDebug(self, string):
     LogDebug(string, self.remoteIp)
@@ -54,6 +73,13 @@ class SymbolicationRequest:
     self.appName = ""
     self.osName = ""
     self.forwardCount = 0
+    # Symbols for frames of modules owned by other cluster nodes,
+    # keyed by (stack index, frame index)
+    self.ownerSymbols = None
+    self.ownerModuleIndexes = set()
+    # Per memory map entry: its SymbolInfo, None when the symbols are
+    # missing, or OWNED_ELSEWHERE
+    self.moduleSymbols = None
 
   def ParseRequests(self, rawRequests):
     self.isValidRequest = False
@@ -115,20 +141,31 @@ class SymbolicationRequest:
       if version < 4:
         self.includeKnownModulesInResponse = False
 
-      # Check stack is well-formatted
+      # Check stack is well-formatted. Each stack is flattened in one pass,
+      # which fails on entries that aren't sequences, then split into a flat
+      # list of module indexes and a flat list of offsets. Entries that
+      # aren't integer pairs fail the length or the module index check.
+      moduleCount = len(self.combinedMemoryMap)
       for stack in stacks:
         if not isinstance(stack, list):
           self.LogDebug("stack is not a list")
           return
-        for entry in stack:
-          if not isinstance(entry, list):
-            self.LogDebug("stack entry is not a list")
-            return
-          if len(entry) != 2:
-            self.LogDebug("stack entry doesn't have exactly 2 elements")
-            return
 
-        self.stacks.append(stack)
+        try:
+          entries = list(chain.from_iterable(stack))
+        except TypeError:
+          self.LogDebug("stack entry is not a list")
+          return
+        if len(entries) != 2 * len(stack):
+          self.LogDebug("stack entry doesn't have exactly 2 elements")
+          return
+
+        moduleIndexes = entries[0::2]
+        if moduleIndexes and (min(moduleIndexes) < -1 or max(moduleIndexes) >= moduleCount):
+          self.LogDebug("stack entry has an invalid module index")
+          return
+
+        self.stacks.append((moduleIndexes, entries[1::2]))
 
     except Exception as e:
       self.LogDebug("Exception while parsing request: " + str(e))
@@ -211,56 +248,155 @@ class SymbolicationRequest:
       self.LogError("Exception while parsing server response to forwarded request: " + str(e))
       return
 
+  # In cluster mode, the frames of every module owned by another node are
+  # sent to that node by the web front end, in one request per node covering
+  # all the stacks. Requests forwarded by other nodes only hold modules owned
+  # by this node, and are not forwarded again. Returns (node URL, module
+  # indexes) pairs.
+  def GetOwnerModules(self, hashRing):
+    if hashRing is None or self.forwardCount > 0:
+      return []
+
+    ownerModules = {}
+    for moduleIndex, module in enumerate(self.combinedMemoryMap):
+      if module[0] and not hashRing.IsLocal(module):
+        ownerModules.setdefault(hashRing.GetOwner(module), []).append(moduleIndex)
+    return sorted(ownerModules.iteritems())
+
+  # The frames of the given modules, as stacks indexing the modules in
+  # order, and the (stack index, frame index) position of each frame
+  def GetOwnerFrames(self, moduleIndexes):
+    oldIndexToNewIndex = dict((oldIndex, newIndex) for newIndex, oldIndex in enumerate(moduleIndexes))
+
+    rawStacks = []
+    framePositions = []
+    for stackIndex, (stackModuleIndexes, offsets) in enumerate(self.stacks):
+      rawStack = []
+      for pcIndex, (moduleIndex, offset) in enumerate(izip(stackModuleIndexes, offsets)):
+        newIndex = oldIndexToNewIndex.get(moduleIndex)
+        if newIndex is not None:
+          rawStack.append([newIndex, offset])
+          framePositions.append((stackIndex, pcIndex))
+      rawStacks.append(rawStack)
+    return rawStacks, framePositions
+
+  # Bodies of the requests to send to other cluster nodes, keyed by node URL.
+  # The web front end calls this without a symFileManager.
+  def MakeOwnerRequests(self, hashRing):
+    ownerRequests = {}
+    for url, moduleIndexes in self.GetOwnerModules(hashRing):
+      rawStacks, framePositions = self.GetOwnerFrames(moduleIndexes)
+      self.LogDebug("Forwarding " + str(len(framePositions)) + " PCs to cluster node " + url)
+      ownerRequests[url] = json.dumps({
+        "stacks": rawStacks,
+        "memoryMap": [list(self.combinedMemoryMap[moduleIndex]) for moduleIndex in moduleIndexes],
+        "forwarded": self.forwardCount + 1,
+        "version": 4
+      })
+    return ownerRequests
+
+  # Use the responses of other cluster nodes to the requests of
+  # MakeOwnerRequests, keyed by node URL. The modules of nodes without a
+  # valid response are symbolicated locally instead.
+  def SetOwnerResponses(self, ownerResponses):
+    self.ownerSymbols = {}
+    for url, moduleIndexes in self.GetOwnerModules(self.symFileManager.hashRing):
+      responseBody = ownerResponses.get(url)
+      if responseBody is None:
+        continue
+
+      _, framePositions = self.GetOwnerFrames(moduleIndexes)
+      try:
+        responseJson = json.loads(responseBody)
+        responseSymbols = [symbol for stack in responseJson["symbolicatedStacks"] for symbol in stack]
+        if len(responseSymbols) != len(framePositions):
+          self.LogError(str(len(responseSymbols)) + " symbols in response from " + url + ", " + \
+                        str(len(framePositions)) + " PCs in request!")
+          continue
+        responseKnownModules = responseJson["knownModules"]
+      except Exception as e:
+        self.LogError("Exception while parsing response of cluster node " + url + ": " + str(e))
+        continue
+
+      for position, symbol in zip(framePositions, responseSymbols):
+        self.ownerSymbols[position] = symbol
+      for newIndex, known in enumerate(responseKnownModules[:len(moduleIndexes)]):
+        if known:
+          self.knownModules[moduleIndexes[newIndex]] = True
+      self.ownerModuleIndexes.update(moduleIndexes)
+
+  # Modules symbolicated by this server rather than by other cluster nodes
+  def GetLocalModules(self):
+    if self.ownerSymbols is None:
+      self.SetOwnerResponses({})
+
+    return [module for moduleIndex, module in enumerate(self.combinedMemoryMap) \
+              if moduleIndex not in self.ownerModuleIndexes]
+
+  # Look up the symbols of every module once for the whole request, unless
+  # the caller already has them (e.g. for a whole batch of requests)
+  def LoadModuleSymbols(self, symbols=None):
+    localModules = self.GetLocalModules()
+    if symbols is None:
+      symbols = self.symFileManager.GetLibSymbolMaps(localModules, self.timer)
+
+    self.moduleSymbols = []
+    for moduleIndex, module in enumerate(self.combinedMemoryMap):
+      if moduleIndex in self.ownerModuleIndexes:
+        self.moduleSymbols.append(OWNED_ELSEWHERE)
+      elif module in symbols:
+        self.moduleSymbols.append(symbols[module])
+        self.knownModules[moduleIndex] = True
+      else:
+        self.moduleSymbols.append(None)
+
   def Symbolicate(self, stackNum):
+    if self.moduleSymbols is None:
+      self.LoadModuleSymbols()
+
     # Check if we should forward requests when required sym files don't exist
     shouldForwardRequests = False
     if self.symFileManager.sOptions["remoteSymbolServer"] and self.forwardCount < MAX_FORWARDED_REQUESTS:
       shouldForwardRequests = True
 
     # Symbolicate each PC
-    pcIndex = -1
     symbolicatedStack = []
-    missingSymFiles = []
     unresolvedIndexes = []
     unresolvedStack = []
     unresolvedModules = []
-    stack = self.stacks[stackNum]
-
-    symbols = self.symFileManager.GetLibSymbolMaps(self.combinedMemoryMap)
-    for moduleIndex, module in enumerate(self.combinedMemoryMap):
-      if module not in symbols:
-        missingSymFiles.append(module)
-        if shouldForwardRequests:
-          unresolvedModules.append((moduleIndex, module))
-      else:
-        self.knownModules[moduleIndex] = True
-
-    for entry in stack:
-      pcIndex += 1
-      moduleIndex = entry[0]
-      offset = entry[1]
-      if moduleIndex == -1:
-        symbolicatedStack.append(hex(offset))
-        continue
-      module = self.combinedMemoryMap[moduleIndex]
-
-      if module in missingSymFiles:
-        if shouldForwardRequests:
-          unresolvedIndexes.append(pcIndex)
-          unresolvedStack.append(entry)
-        symbolicatedStack.append(hex(offset) + " (in " + module[0] + ")")
-        continue
-
-      functionName = None
-      libSymbolMap = symbols[module]
-      functionName = libSymbolMap.Lookup(offset)
-
-      if functionName == None:
-        functionName = hex(offset)
-      symbolicatedStack.append(functionName + " (in " + module[0] + ")")
+    moduleIndexes, offsets = self.stacks[stackNum]
+    moduleSymbols = self.moduleSymbols
+    moduleSuffixes = [" (in " + module[0] + ")" for module in self.combinedMemoryMap]
+
+    if shouldForwardRequests:
+      unresolvedModules = [(moduleIndex, module) for moduleIndex, module in enumerate(self.combinedMemoryMap) \
+                             if moduleSymbols[moduleIndex] is None]
+
+    with self.timer.Phase("lookup"):
+      for pcIndex, (moduleIndex, offset) in enumerate(izip(moduleIndexes, offsets)):
+        if moduleIndex == -1:
+          symbolicatedStack.append(hex(offset))
+          continue
+
+        libSymbolMap = moduleSymbols[moduleIndex]
+        if libSymbolMap is None:
+          if shouldForwardRequests:
+            unresolvedIndexes.append(pcIndex)
+            unresolvedStack.append((moduleIndex, offset))
+          symbolicatedStack.append(hex(offset) + moduleSuffixes[moduleIndex])
+          continue
+        if libSymbolMap is OWNED_ELSEWHERE:
+          symbolicatedStack.append(self.ownerSymbols[(stackNum, pcIndex)])
+          continue
+
+        functionName = libSymbolMap.Lookup(offset)
+        if functionName == None:
+          functionName = hex(offset)
+        symbolicatedStack.append(functionName + moduleSuffixes[moduleIndex])
 
     # Ask another server for help symbolicating unresolved addresses
     if len(unresolvedStack) > 0:
-      self.ForwardRequest(unresolvedIndexes, unresolvedStack, unresolvedModules, symbolicatedStack)
+      with self.timer.Phase("forward"):
+        self.ForwardRequest(unresolvedIndexes, unresolvedStack, unresolvedModules, symbolicatedStack)
 
     return symbolicatedStack
@@ -1,20 +1,25 @@
 #!/usr/bin/env python
 
 from symLogging import LogDebug, LogError, LogMessage, SetLoggingOptions, SetDebug, CheckDebug
-from symFileManager import SymFileManager
-from symbolicationRequest import SymbolicationRequest
+from symResponseCache import ResponseCache, MakeETag
+from symbolicationRequest import SymbolicationRequest, getModuleV3
+from symCluster import CreateHashRing
 from concurrent.futures import ProcessPoolExecutor as Pool
 
 import sys
 import os
+import hmac
 import json
+import time
 import signal
 import tempfile
 import ConfigParser
+from collections import OrderedDict
 from collections import OrderedDict as _default_dict
 import tornado.gen
+from tornado.httpclient import AsyncHTTPClient
 from tornado.ioloop import IOLoop, PeriodicCallback
-from tornado.web import Application, RequestHandler, url
+from tornado.web import Application, RequestHandler, stream_request_body, url
 
 # Report errors while symLogging is not configured yet
 import logging
@@ -25,18 +30,47 @@ gSymFileManager = None
 # Pool of symbolication workers
 gPool = None
 
+# Process ids of the initialized workers
+gReadyWorkers = set()
+
+# Delay in seconds before submitting another worker initialization job,
+# doubled after every failed initialization up to WORKER_INIT_MAX_RETRY_DELAY
+WORKER_INIT_RETRY_DELAY = 0.5
+WORKER_INIT_MAX_RETRY_DELAY = 60
+
+# Failed worker initializations since the last successful one
+gWorkerInitFailures = 0
+
+# Responses to recent requests, in the web front end
+gResponseCache = None
+
+# Ownership of libraries in cluster mode, None when standalone. The web
+# front end and the workers build the same ring from the options.
+gHashRing = None
+
+# Size in bytes of the largest request body decoded by the web front end,
+# larger ones are only decoded by the workers so that they don't hold up
+# the other connections
+MAX_FRONTEND_DECODE_SIZE = 256 * 1024
+
 # Default config options
 gOptions = {
   # IP address to listen on
   "hostname": "0.0.0.0",
   # TCP port to listen on
   "portNumber": 80,
-  # Trace-level logging (verbose)
+  # Trace-level logging (verbose). Also returns per-phase timings
+  # in the X-Symbolication-Timings response header
   "enableTracing": 0,
+  # Log the phase breakdown of requests slower than this (in ms, 0 = off)
+  "slowRequestThreshold": 0,
   # Fallback server if symbol is not found locally
   "remoteSymbolServer": "",
   # Maximum number of symbol files to keep in memory
   "maxMemCacheFiles": 400,
+  # Load the memory cache of the previous run in the background at startup,
+  # otherwise its entries are only loaded on first use
+  "warmMemoryCache": 1,
   # Paths to .SYM files
   "symbolPaths": [
     # Default to empty so users don't have to list anything in their config
@@ -45,10 +79,53 @@ gOptions = {
   # URLs to symbol stores
   "symbolURLs": [
   ],
+  # Timeout in seconds of each attempt to download a symbol file
+  "fetchTimeout": 30,
+  # Retries of a failed download (missing files aren't retried)
+  "fetchRetries": 2,
+  # Delay in ms before the first retry, doubled for every other retry
+  "fetchBackoff": 500,
+  # Start downloading from the next symbol URL when a download isn't done
+  # after this many ms, and use the first to succeed (0 = try URLs in order)
+  "hedgeDelay": 0,
   # Symbol files cache path
   "diskCachePath": os.path.join(tempfile.gettempdir(), 'snappy', 'cache'),
   # Maximum number of cache files
-  "maxDiskCacheFiles": 1500
+  "maxDiskCacheFiles": 1500,
+  # Maximum total size of the cache files in MB (0 = no limit)
+  "maxDiskCacheSize": 0,
+  # Compression of cache files: none, zlib or lz4 (when installed)
+  "diskCacheCodec": "none",
+  # Memory map cache files instead of loading them, so that the worker
+  # processes share one copy of each library (uncompressed entries only)
+  "sharedSymbolTables": 0,
+  # Maximum total size of cached responses in MB (0 = no response cache)
+  "maxResponseCacheSize": 64,
+  # Seconds to cache responses with modules that couldn't be symbolicated,
+  # e.g. after an error fetching symbols (0 = don't cache them)
+  "incompleteResponseTTL": 60,
+  # Cache eviction policy: mru, or tinylfu for frequency-aware admission
+  "cachePolicy": "mru",
+  # Number of requests of a /batch request symbolicated together
+  "batchChunkSize": 100,
+  # Maximum size of a /batch request body in MB, which is streamed rather
+  # than buffered
+  "maxBatchSize": 1024,
+  # Number of symbolication worker processes
+  "numWorkers": 1,
+  # Shared secret for the /prefetch endpoint (empty = endpoint disabled)
+  "prefetchToken": "",
+  # Maximum number of symbol files fetched in parallel by /prefetch
+  "prefetchConcurrency": 4,
+  # URLs of all the nodes of the cluster, including this one
+  "clusterNodes": [
+  ],
+  # URL of this node, as listed in the ClusterNodes section
+  "clusterSelf": "",
+  # Timeout in seconds of requests forwarded to other cluster nodes
+  "clusterTimeout": 30,
+  # Points per node on the consistent hash ring
+  "clusterVirtualNodes": 100
 }
 
 # Use a new class to make defaults case-sensitive
@@ -72,6 +149,9 @@ class CaseSensitiveConfigParser(ConfigParser.SafeConfigParser):
 def initializeSubprocess(options):
   global gSymFileManager
 
+  if gSymFileManager is not None:
+    return os.getpid()
+
   # Ignore ctrl-c in the subprocess
   signal.signal(signal.SIGINT, signal.SIG_IGN)
 
@@ -80,32 +160,245 @@ def initializeSubprocess(options):
     options["Log"]["logPath"] = os.path.join(options["Log"]["logPath"], "subprocess")
   SetLoggingOptions(options["Log"])
 
+  # The symbol file modules are only imported by the workers, which keeps
+  # them out of the web front end
+  from symFileManager import SymFileManager
+
   # Create the .SYM cache manager singleton
   gSymFileManager = SymFileManager(options)
+  return os.getpid()
+
+# The pool doesn't hand out jobs one per worker: initialization jobs are
+# submitted until every worker has run one
+def submitWorkerInitialization():
+  future = gPool.submit(initializeSubprocess, gOptions)
+  IOLoop.current().add_future(future, onWorkerInitialized)
+
+def onWorkerInitialized(future):
+  global gWorkerInitFailures
+
+  if future.exception() is not None:
+    # Only the first of a series of failures is worth an error
+    if not gWorkerInitFailures:
+      LogError("Worker initialization failed, retrying: " + str(future.exception()))
+    else:
+      LogDebug("Worker initialization failed again: " + str(future.exception()))
+    gWorkerInitFailures += 1
+  else:
+    gWorkerInitFailures = 0
+    if future.result() not in gReadyWorkers:
+      gReadyWorkers.add(future.result())
+      if len(gReadyWorkers) == gOptions["numWorkers"]:
+        LogMessage("All {} workers are ready".format(len(gReadyWorkers)))
+
+  if len(gReadyWorkers) < gOptions["numWorkers"]:
+    delay = min(WORKER_INIT_RETRY_DELAY * 2 ** gWorkerInitFailures, WORKER_INIT_MAX_RETRY_DELAY)
+    IOLoop.current().call_later(delay, submitWorkerInitialization)
+
+def reportTimings(timer, options, remoteIp):
+  if not timer.IsEnabled():
+    return None
 
-def processSymbolicationRequest(rawRequest, remoteIp):
-  decodedRequest = json.loads(rawRequest)
-  request = SymbolicationRequest(gSymFileManager, decodedRequest, remoteIp)
+  totalMs = timer.GetTotal() * 1000
+  threshold = options["slowRequestThreshold"]
+  if threshold and totalMs >= threshold:
+    LogMessage("Slow request: " + json.dumps({
+      "totalMs": round(totalMs, 3),
+      "phases": timer.GetPhases(),
+      "libs": timer.libs }), remoteIp)
+
+  if not options["enableTracing"]:
+    return None
+  return timer.FormatHeader()
+
+# Workers that get a request before their initialization job initialize
+# themselves on that request
+def getSymFileManager(options):
+  initializeSubprocess(options)
+  return gSymFileManager
+
+# In cluster mode, returns the requests to send to other cluster nodes for
+# a request, see SymbolicationRequest.MakeOwnerRequests. The web front end
+# sends them, so that workers never wait on other nodes.
+def makeOwnerRequests(hashRing, rawRequest, remoteIp, decodedRequest=None):
+  if decodedRequest is None:
+    try:
+      decodedRequest = json.loads(rawRequest)
+    except ValueError:
+      return {}
+
+  request = SymbolicationRequest(None, decodedRequest, remoteIp)
+  if not request.isValidRequest:
+    return {}
+  return request.MakeOwnerRequests(hashRing)
+
+# makeOwnerRequests in a worker, for requests too large to be decoded by the
+# web front end and for the chunks of batches
+def prepareOwnerRequests(rawRequests, remoteIp, options):
+  hashRing = getSymFileManager(options).hashRing
+  return [makeOwnerRequests(hashRing, rawRequest, remoteIp) for rawRequest in rawRequests]
+
+# The request's phase timings count from receivedTime, when the web front
+# end got it, and include the forwardTime it spent waiting on other nodes
+# and the time it spent queued in the pool
+def processSymbolicationRequest(rawRequest, remoteIp, options, ownerResponses=None, receivedTime=None, forwardTime=0):
+  from symTiming import CreateTimer
+
+  symFileManager = getSymFileManager(options)
+  timer = CreateTimer(options, receivedTime)
+  if forwardTime:
+    timer.Add("forward", forwardTime)
+  if receivedTime:
+    # Time spent waiting for a free worker
+    timer.Add("queue", time.time() - receivedTime - forwardTime)
+
+  with timer.Phase("decode"):
+    decodedRequest = json.loads(rawRequest)
+  request = SymbolicationRequest(symFileManager, decodedRequest, remoteIp, timer)
   if not request.isValidRequest:
     LogDebug("Unable to parse request", remoteIp)
-    return None
+    return None, None, False
+  if ownerResponses:
+    request.SetOwnerResponses(ownerResponses)
+
+  response, complete = symbolicateRequest(request)
+
+  with timer.Phase("serialize"):
+    response = json.dumps(response)
+
+  return response, reportTimings(timer, options, remoteIp), complete
 
+# Returns the response, and whether every named module with frames in the
+# request was symbolicated. Other responses may only reflect a temporary
+# failure to fetch symbols.
+def symbolicateRequest(request):
   response = { 'symbolicatedStacks': [] }
+  usedModules = set()
   for stackIndex in range(len(request.stacks)):
     symbolicatedStack = request.Symbolicate(stackIndex)
+    usedModules.update(request.stacks[stackIndex][0])
 
     # Free up memory ASAP
     request.stacks[stackIndex] = []
 
     response['symbolicatedStacks'].append(symbolicatedStack)
 
+  complete = all(request.knownModules[moduleIndex] for moduleIndex in usedModules
+                 if moduleIndex >= 0 and request.combinedMemoryMap[moduleIndex][0])
   response['knownModules'] = request.knownModules[:]
   if not request.includeKnownModulesInResponse:
     response = response['symbolicatedStacks']
 
   request.Reset()
 
-  return json.dumps(response)
+  return response, complete
+
+# Symbolicate a chunk of a batch. The symbols of all the libraries used by
+# the chunk's requests are looked up once, then shared by the requests.
+# Returns one JSON line per request, "null" for invalid requests and for
+# requests that failed to symbolicate.
+def processBatchRequest(rawRequests, remoteIp, options, ownerResponses=None):
+  symFileManager = getSymFileManager(options)
+
+  requests = []
+  for requestIndex, rawRequest in enumerate(rawRequests):
+    try:
+      decodedRequest = json.loads(rawRequest)
+    except ValueError:
+      decodedRequest = None
+    request = SymbolicationRequest(symFileManager, decodedRequest, remoteIp)
+    if ownerResponses and request.isValidRequest:
+      request.SetOwnerResponses(ownerResponses[requestIndex])
+    requests.append(request)
+
+  libs = OrderedDict()
+  for request in requests:
+    if request.isValidRequest:
+      for module in request.GetLocalModules():
+        libs[module] = True
+  symbols = symFileManager.GetLibSymbolMaps(libs.keys())
+
+  responses = []
+  for request in requests:
+    if not request.isValidRequest:
+      LogDebug("Unable to parse batched request", remoteIp)
+      responses.append("null")
+      continue
+    try:
+      request.LoadModuleSymbols(symbols)
+      responses.append(json.dumps(symbolicateRequest(request)[0]))
+    except Exception as e:
+      LogDebug("Unable to symbolicate batched request: " + str(e), remoteIp)
+      responses.append("null")
+
+  return "\n".join(responses) + "\n"
+
+# Returns the libs of a prefetch request, whether to load them in the memory
+# cache, and whether the request was forwarded by another cluster node, or
+# None if the request is invalid
+def parsePrefetchRequest(rawRequest, remoteIp):
+  decodedRequest = json.loads(rawRequest)
+  if not isinstance(decodedRequest, dict) or not isinstance(decodedRequest.get("libs"), list):
+    LogDebug("Prefetch request is missing the 'libs' list", remoteIp)
+    return None
+
+  libs = []
+  for entry in decodedRequest["libs"]:
+    if not isinstance(entry, list) or len(entry) != 2:
+      LogDebug("Prefetch entry is not a 2 item list: " + str(entry), remoteIp)
+      return None
+    lib = getModuleV3(*entry)
+    if lib is None or not lib[0]:
+      return None
+    libs.append(lib)
+
+  return libs, bool(decodedRequest.get("memory", False)), "forwarded" in decodedRequest
+
+def processPrefetchRequest(libs, toMemory, options):
+  return getSymFileManager(options).Prefetch(libs, toMemory)
+
+# Send the requests returned by prepareOwnerRequests to the other cluster
+# nodes, all in parallel. Returns the matching lists of response bodies keyed
+# by node URL, without the nodes that failed to answer.
+@tornado.gen.coroutine
+def sendOwnerRequests(ownerRequests, remoteIp):
+  client = AsyncHTTPClient()
+  positions = []
+  futures = []
+  for requestIndex, requests in enumerate(ownerRequests):
+    for nodeURL, body in requests.iteritems():
+      positions.append((requestIndex, nodeURL))
+      futures.append(sendOwnerRequest(client, nodeURL, body, remoteIp))
+
+  ownerResponses = [{} for _ in ownerRequests]
+  responseBodies = (yield futures) if futures else []
+  for (requestIndex, nodeURL), responseBody in zip(positions, responseBodies):
+    if responseBody is not None:
+      ownerResponses[requestIndex][nodeURL] = responseBody
+  raise tornado.gen.Return(ownerResponses)
+
+# Returns the response body, or None if the node failed to answer
+@tornado.gen.coroutine
+def sendOwnerRequest(client, nodeURL, body, remoteIp, headers=None):
+  requestHeaders = { "Content-Type": "application/json" }
+  if headers:
+    requestHeaders.update(headers)
+  try:
+    response = yield client.fetch(
+                nodeURL,
+                method="POST",
+                body=body,
+                headers=requestHeaders,
+                request_timeout=gOptions["clusterTimeout"])
+  except Exception as e:
+    LogError("Exception while forwarding request to cluster node " + nodeURL + ": " + str(e), remoteIp)
+    raise tornado.gen.Return(None)
+  raise tornado.gen.Return(response.body)
+
+# Requests forwarded by other cluster nodes are never forwarded again, which
+# the substring check tells without decoding them
+def needsOwnerRequests(requestBody):
+  return gHashRing is not None and '"forwarded"' not in requestBody
 
 class DebugHandler(RequestHandler):
   def get(self, path):
@@ -117,6 +410,21 @@ class DebugHandler(RequestHandler):
       self.set_status(200)
       self.set_header("Content-type", "application/json")
 
+# /health/live answers as long as the front end runs, /health/ready only once
+# every worker has been initialized
+class HealthHandler(RequestHandler):
+  def head(self, check):
+    self.get(check)
+
+  def get(self, check):
+    readyWorkers = len(gReadyWorkers)
+    ready = readyWorkers >= gOptions["numWorkers"]
+    self.set_status(200 if check == "live" or ready else 503)
+    self.set_header("Content-type", "application/json")
+    self.set_header("Cache-Control", "no-cache")
+    if self.request.method != "HEAD":
+      self.write(json.dumps({ "ready": ready, "readyWorkers": readyWorkers, "workers": gOptions["numWorkers"] }))
+
 class SymbolHandler(RequestHandler):
   def LogDebug(self, string):
     LogDebug(string, self.remoteIp)
@@ -145,6 +453,7 @@ class SymbolHandler(RequestHandler):
   def post(self, path):
     self.LogDebug("Received request with path '{}'".format(path))
 
+    receivedTime = time.time()
     try:
       CheckDebug()
       requestBody = self.request.body
@@ -156,28 +465,202 @@ class SymbolHandler(RequestHandler):
 
       self.LogDebug("Request body: " + requestBody)
 
-      response = yield gPool.submit(
+      cacheKey, cached, decodedRequest = gResponseCache.Lookup(requestBody) if gResponseCache else (None, None, None)
+      if cached:
+        self.LogDebug("Response cache hit")
+        self.sendResponse(cached[0], cached[1], None)
+        return
+
+      ownerResponses = None
+      forwardTime = 0
+      if needsOwnerRequests(requestBody):
+        if len(requestBody) <= MAX_FRONTEND_DECODE_SIZE:
+          ownerRequests = [makeOwnerRequests(gHashRing, requestBody, self.remoteIp, decodedRequest)]
+        else:
+          ownerRequests = yield gPool.submit(prepareOwnerRequests, [requestBody], self.remoteIp, gOptions)
+        if ownerRequests[0]:
+          forwardStart = time.time()
+          ownerResponses = (yield sendOwnerRequests(ownerRequests, self.remoteIp))[0]
+          forwardTime = time.time() - forwardStart
+
+      response, timings, complete = yield gPool.submit(
                   processSymbolicationRequest,
                   requestBody,
-                  self.remoteIp)
+                  self.remoteIp,
+                  gOptions,
+                  ownerResponses,
+                  receivedTime,
+                  forwardTime)
 
       if response is None:
         self.LogDebug("Unable to parse request")
         self.sendHeaders(400)
         return
+
+      etag = MakeETag(response)
+      if cacheKey and complete:
+        gResponseCache.Put(cacheKey, response, etag)
+      elif cacheKey and gOptions["incompleteResponseTTL"]:
+        gResponseCache.Put(cacheKey, response, etag, gOptions["incompleteResponseTTL"])
     except Exception as e:
       self.LogDebug("Unable to parse request body: " + str(e))
       # Ensure connection is back in blocking mode so rfile/wfile can be used safely
       self.sendHeaders(400)
       return
 
+    self.sendResponse(response, etag, timings)
+
+  def sendResponse(self, response, etag, timings):
     try:
+      if timings:
+        self.set_header("X-Symbolication-Timings", timings)
+      self.set_header("ETag", etag)
+      ifNoneMatch = self.request.headers.get("If-None-Match", "")
+      if etag in [tag.strip() for tag in ifNoneMatch.split(",")]:
+        self.set_status(304)
+        return
+
       self.sendHeaders(200)
       self.LogDebug("Response: " + response)
       self.write(response)
     except Exception as e:
       self.LogError("Exception in post: " + str(e))
 
+# The body is read as a stream: the requests are queued in chunks as their
+# lines arrive, so that several workers can share the batch, and the
+# responses are sent back in order once the body has been read
+@stream_request_body
+class BatchHandler(SymbolHandler):
+  def prepare(self):
+    super(BatchHandler, self).prepare()
+    self.request.connection.set_max_body_size(gOptions["maxBatchSize"] * 1024 * 1024)
+    # Start of a request line not received in full yet
+    self.partialLine = ""
+    self.chunkRequests = []
+    # (future of the chunk's responses, number of requests in the chunk)
+    self.chunks = []
+
+  def get(self):
+    self.sendHeaders(405)
+
+  def head(self):
+    self.sendHeaders(405)
+
+  def data_received(self, data):
+    lines = (self.partialLine + data).split("\n")
+    self.partialLine = lines.pop()
+    self.addRequests(lines)
+
+  def addRequests(self, lines):
+    for line in lines:
+      if line.strip():
+        self.chunkRequests.append(line)
+      if len(self.chunkRequests) >= gOptions["batchChunkSize"]:
+        self.submitChunk()
+
+  def submitChunk(self):
+    if self.chunkRequests:
+      self.chunks.append((self.symbolicateChunk(self.chunkRequests), len(self.chunkRequests)))
+      self.chunkRequests = []
+
+  @tornado.gen.coroutine
+  def post(self):
+    self.addRequests([self.partialLine])
+    self.submitChunk()
+    self.LogDebug("Received batch of {} requests".format(sum(requestCount for _, requestCount in self.chunks)))
+
+    self.set_status(200)
+    self.set_header("Content-type", "application/x-ndjson")
+    for future, requestCount in self.chunks:
+      try:
+        response = yield future
+      except Exception as e:
+        self.LogError("Exception in batch: " + str(e))
+        response = "null\n" * requestCount
+      self.write(response)
+      yield self.flush()
+
+  @tornado.gen.coroutine
+  def symbolicateChunk(self, chunkRequests):
+    ownerResponses = None
+    if gHashRing is not None:
+      ownerRequests = yield gPool.submit(prepareOwnerRequests, chunkRequests, self.remoteIp, gOptions)
+      if any(ownerRequests):
+        ownerResponses = yield sendOwnerRequests(ownerRequests, self.remoteIp)
+
+    response = yield gPool.submit(processBatchRequest, chunkRequests, self.remoteIp, gOptions, ownerResponses)
+    raise tornado.gen.Return(response)
+
+class PrefetchHandler(SymbolHandler):
+  def isAuthorized(self):
+    token = gOptions["prefetchToken"]
+    authorization = self.request.headers.get("Authorization", "")
+    if not token or not authorization.startswith("Bearer "):
+      return False
+    return hmac.compare_digest(authorization[len("Bearer "):], token)
+
+  def get(self):
+    self.sendHeaders(405)
+
+  def head(self):
+    self.sendHeaders(405)
+
+  @tornado.gen.coroutine
+  def post(self):
+    if not self.isAuthorized():
+      self.LogMessage("Rejected unauthorized prefetch request")
+      self.sendHeaders(403)
+      return
+
+    try:
+      prefetchRequest = parsePrefetchRequest(self.request.body, self.remoteIp)
+    except ValueError as e:
+      self.LogDebug("Unable to parse prefetch request: " + str(e))
+      prefetchRequest = None
+
+    if prefetchRequest is None:
+      self.sendHeaders(400)
+      return
+
+    # In cluster mode, libraries are only cached by the node owning them
+    libs, toMemory, forwarded = prefetchRequest
+    ownerLibs = {}
+    if gHashRing is not None and not forwarded:
+      for lib in libs:
+        ownerLibs.setdefault(gHashRing.GetOwner(lib), []).append(lib)
+      libs = ownerLibs.pop(gHashRing.selfNode, [])
+
+    try:
+      queued = yield [gPool.submit(processPrefetchRequest, libs, toMemory, gOptions)] + \
+                     [self.forwardPrefetch(nodeURL, nodeLibs, toMemory) for nodeURL, nodeLibs in ownerLibs.iteritems()]
+    except Exception as e:
+      self.LogError("Exception in prefetch: " + str(e))
+      self.sendHeaders(500)
+      return
+
+    self.sendHeaders(202)
+    self.write(json.dumps({ "queued": sum(queued) }))
+
+  # Returns the number of libs the node queued for prefetching
+  @tornado.gen.coroutine
+  def forwardPrefetch(self, nodeURL, libs, toMemory):
+    body = json.dumps({ "libs": [list(lib) for lib in libs], "memory": toMemory, "forwarded": 1 })
+    responseBody = yield sendOwnerRequest(
+                AsyncHTTPClient(),
+                nodeURL + "prefetch",
+                body,
+                self.remoteIp,
+                { "Authorization": self.request.headers["Authorization"] })
+    if responseBody is None:
+      raise tornado.gen.Return(0)
+
+    try:
+      queued = json.loads(responseBody)["queued"]
+    except Exception as e:
+      self.LogError("Invalid prefetch response from cluster node " + nodeURL + ": " + str(e))
+      queued = 0
+    raise tornado.gen.Return(queued)
+
 def SetConfigOptions(options):
   for (option, value) in options:
     if option not in gOptions:
@@ -238,20 +721,27 @@ def ReadConfigFile():
     if configURLs:
       gOptions["symbolURLs"] = [url for name, url in configURLs if name not in environ]
 
+  # Get the list of cluster nodes from the config file
+  if configParser.has_section("ClusterNodes"):
+    configNodes = configParser.items("ClusterNodes")
+    if configNodes:
+      gOptions["clusterNodes"] = [node for name, node in configNodes if name not in environ]
+
   gOptions["Log"] = dict(configParser.items("Log"))
 
   return True
 
 def Main():
-  global gSymFileManager, gOptions, gPool
+  global gSymFileManager, gOptions, gPool, gResponseCache, gHashRing
 
   if not ReadConfigFile():
     return 1
 
-  # In a perfect world, we could create a process per cpu core.
-  # But then we'd have to deal with cache sharing
-  gPool = Pool(1)
-  gPool.submit(initializeSubprocess, gOptions)
+  # Workers share the disk cache directory, but each one has its own
+  # memory cache
+  gPool = Pool(gOptions["numWorkers"])
+  for _ in range(gOptions["numWorkers"]):
+    submitWorkerInitialization()
 
   # Setup logging in the parent process.
   # Ensure this is called after the call to initializeSubprocess to
@@ -260,9 +750,17 @@ def Main():
 
   LogMessage("Starting server with the following options:\n" + str(gOptions))
 
+  gHashRing = CreateHashRing(gOptions)
+
+  if gOptions["maxResponseCacheSize"]:
+    gResponseCache = ResponseCache(gOptions["maxResponseCacheSize"] * 1024 * 1024, MAX_FRONTEND_DECODE_SIZE)
+
   app = Application([
     url(r'/(debug)', DebugHandler),
     url(r'/(nodebug)', DebugHandler),
+    url(r'/health/(live|ready)', HealthHandler),
+    url(r'/prefetch', PrefetchHandler),
+    url(r'/batch', BatchHandler),
     url(r"(.*)", SymbolHandler)])
 
   app.listen(gOptions['portNumber'], gOptions['hostname'])